@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+'''Micro-benchmark of normalize.py against the original character scans.
+
+Every whitespace-separated token of the given books is normalized by
+both versions, the results are checked to be identical and the time of
+each version is printed.
+'''
+import argparse
+import string, sys, time
+import normalize
+
+def valid(sentence):
+  for word in sentence.split():
+    if not all(c in string.printable for c in word):
+      return False
+    has_digit = any(c in string.digits for c in word)
+    has_alpha = any(c in string.ascii_letters for c in word)
+    if has_digit and has_alpha:
+      return False
+    if has_alpha:
+      if not any(c in ['a','e','i','o','u','y'] for c in word):
+        return False
+  return True
+
+def word_normalize(word):
+  if any(c.isdigit() for c in word):
+    return '0'
+  if any(c.isalpha() for c in word):
+    if not all(c.isalpha() for c in word):
+      if len(word)>1 and word[0]=='\'' and word[1].isalpha() and len(word)<4:
+        return word
+      return ''.join(c if c.isalpha() else '' for c in word)
+  return word
+
+def bench(func, items, repeat):
+  '''best time of repeat runs of func over items, and its results'''
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    results = [ func(item) for item in items ]
+    best = min(best, time.perf_counter()-start)
+  return best, results
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='Benchmark of word '
+        'normalization on real books.')
+  argparser.add_argument('books', type=str, nargs='+',
+        help='books to be tokenized, ex. Holmes_Training_Data/*.TXT')
+  argparser.add_argument('-r', '--repeat',
+        type=int, default=3,
+        help='Number of runs, the best one is reported.'
+             ' (default: %(default)s)')
+  args = argparser.parse_args()
+
+  words, lines = [], []
+  for book in args.books:
+    with open(book, 'r', encoding='utf-8', errors='ignore') as f:
+      text = f.read()
+    words.extend(text.lower().split())
+    lines.extend(text.splitlines())
+  sys.stderr.write('%d tokens, %d distinct, %d lines\n'
+                   % (len(words), len(set(words)), len(lines)))
+
+  for name, old, new, items in [
+      ('word_normalize', word_normalize, normalize.word_normalize, words),
+      ('valid', valid, normalize.valid, lines)]:
+    old_time, old_results = bench(old, items, args.repeat)
+    # the first run fills the cache, later ones show the steady state
+    normalize.valid_word.cache_clear()
+    normalize.word_normalize.cache_clear()
+    cold_time, new_results = bench(new, items, 1)
+    new_time, _ = bench(new, items, args.repeat)
+    assert old_results == new_results, name+' results differ'
+    print('%-15s original %.3fs  cold %.3fs (%.1fx)  warm %.3fs (%.1fx)'
+          % (name, old_time, cold_time, old_time/cold_time,
+             new_time, old_time/new_time))
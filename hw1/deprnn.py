@@ -5,9 +5,13 @@ import argparse
 import sys
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.util import nest
 from collections import Counter
 import copy
 import csv
+import itertools
+import time
+import tf_input
 
 #default values (in alphabetic order)
 default_batch_size = 256
@@ -21,6 +25,7 @@ default_learning_rate = 0.003
 default_rnn_type = 2
 default_max_grad_norm = 10
 default_max_epoch = 50000
+default_num_clusters = 0
 default_num_sampled = 2000
 default_optimizer = 4
 default_output_filename = './submission.csv'
@@ -35,7 +40,7 @@ def full_softmax(weights, biases, labels, inputs, num_sampled, num_classes):
   return tf.contrib.legacy_seq2seq.sequence_loss_by_example(
          [tf.matmul(inputs, tf.transpose(weights))+biases],
          [tf.reshape(labels, [-1])],
-         [tf.ones([labels.get_shape()[1]*para.batch_size], tf.float32)])
+         [tf.ones_like(tf.reshape(labels, [-1]), dtype=tf.float32)])
 softmax = [full_softmax, tf.nn.sampled_softmax_loss, tf.nn.nce_loss]
 src_name = ['6B.50d', '6B.100d', '6B.200d', '6B.300d', '42B.300d', '840B.300d']
 
@@ -76,9 +81,16 @@ parser.add_argument('-opt', '--optimizer',
                     %default_optimizer)
 parser.add_argument('-sl', '--softmax_loss',
                     type=int, default=default_softmax_loss,
-                    nargs='?', choices=range(0, 3), help='Type of softmax'
+                    nargs='?', choices=range(0, 4), help='Type of softmax'
                     'function --> [0:full softmax], [1:sampled softmax],'
-                    '[nce loss]. (default:%d)'%default_softmax_loss)
+                    '[2:nce loss], [3:two-level hierarchical softmax].'
+                    '(default:%d)'%default_softmax_loss)
+parser.add_argument('-nc', '--num_clusters',
+                    type=int, default=default_num_clusters,
+                    nargs='?', help='Number of word clusters of the two-level '
+                    'hierarchical softmax, 0 for the square root of '
+                    'vocab_size. Clusters that would be empty are dropped. '
+                    '(default:%d)'%default_num_clusters)
 parser.add_argument('-rt', '--rnn_type',
                     type=int, default=default_rnn_type,
                     nargs='?', choices=range(0, 4), help='Type of rnn cell -->'
@@ -104,6 +116,10 @@ parser.add_argument('-me', '--max_epoch',
                     type=int, default=default_max_epoch,
                     nargs='?', help='Maximum epoch to be trained.'
                     '(default:%d)'%default_max_epoch)
+parser.add_argument('-io', '--inference_only', action='store_true',
+                    help='Only build the testing graph and restore the trained '
+                    'weights from ./logs/ to predict, implied by '
+                    '--max_epoch 0.')
 parser.add_argument('-tn', '--train_num',
                     type=int, default=default_train_num,
                     nargs='?', help='Number of files out of the total 522'
@@ -121,6 +137,31 @@ parser.add_argument('-hs', '--hidden_size',
                     type=int, default=default_hidden_size,
                     nargs='?', help='Dimension of hidden layer.'
                     '(default:%d)'%default_hidden_size)
+parser.add_argument('-bb', '--bucket_boundaries',
+                    type=int, default=[], nargs='*',
+                    help='Boundaries of sentence lengths for bucketing. '
+                    'Sentences in the same bucket are batched together. '
+                    '(default: no bucketing)')
+parser.add_argument('-sp', '--share_prefix', action='store_true',
+                    help='While testing, run the part shared by the 5 '
+                    'candidates once and only the differing parts for '
+                    'each candidate.')
+parser.add_argument('-rg', '--ragged', action='store_true',
+                    help='Read data from the flat arrays written by '
+                    'parse.py --ragged instead of TFRecorder files.')
+parser.add_argument('-tr', '--trie', action='store_true',
+                    help='With --use_dep and --ragged, train on whole '
+                    'dependency trees and run the prefixes shared by their '
+                    'paths once.')
+parser.add_argument('-he', '--half_embedding', action='store_true',
+                    help='Store the word embedding as float16, it is cast to '
+                    'float32 at lookup.')
+parser.add_argument('-td', '--tf_data', action='store_true',
+                    help='Read TFRecorder files with the tf.data pipeline of '
+                    'tf_input.py instead of queue runners.')
+parser.add_argument('-ca', '--cache_data', action='store_true',
+                    help='With --tf_data, keep parsed records in memory after '
+                    'the first pass.')
 parser.add_argument('-dd', '--data_dir',
                     type=str, default=default_data_dir, nargs='?',
                     help='Directory where the data are placed.'
@@ -129,26 +170,6 @@ parser.add_argument('-of', '--output_filename',
                     type=str, default=default_output_filename, nargs='?',
                     help='Filename of the final prediction.'
                     '(default:%s)'%default_output_filename)
-args = parser.parse_args()
-
-#calculate real epochs
-print('training with about %.3f epochs!'
-      %((args.batch_size*args.max_epoch)/2100000))
-
-#load in pre-trained word embedding and vocabulary list
-wordvec = np.load('data/wordvec.'+src_name[args.wordvec_src]+'.npy')
-
-#decide vocab_size and embed_dim
-args.vocab_size, args.embed_dim = wordvec.shape
-print('vocab_size = %d'%args.vocab_size)
-print('word embedding dimension = %d'%args.embed_dim)
-
-#load in file list for training and validation
-filenames = open('training_list', 'r').read().splitlines()
-filenames = [ args.data_dir+ff[21:-4]+'.tfr' for ff in filenames ]
-assert len(filenames) == 522
-filenames = [filenames[:default_train_num], filenames[default_train_num:],
-    ['testing_data.tfr']]
 
 def is_train(mode): return mode == 0
 def is_valid(mode): return mode == 1
@@ -160,7 +181,10 @@ def get_single_example(para):
   reader = tf.TFRecordReader()
 
   _, serialized_example = reader.read(f_queue)
+  return parse_example(para, serialized_example)
 
+def parse_example(para, serialized_example):
+  '''word ids of a sentence as a sparse tensor and its number of steps'''
   feature = tf.parse_single_example(serialized_example,
     features={
         'content': tf.VarLenFeature(tf.int64),
@@ -170,12 +194,296 @@ def get_single_example(para):
   else:
     return feature['content'], feature['len'][0]-1
 
+class RaggedData(object):
+
+  '''sequences of word ids stored in a flat array with offsets. The
+  first step_offset words of a sequence only feed the RNN, a sequence of
+  length l has l-step_offset steps.'''
+
+  def __init__(self, ids, offsets, shuffle=True, boundaries=None,
+               step_offset=1):
+    self._ids = ids
+    self._starts = offsets[:-1]
+    self._lens = np.diff(offsets)
+    self._shuffle = shuffle
+    self._boundaries = boundaries
+    self._step_offset = step_offset
+    self._batches = []
+
+  def __len__(self): return len(self._lens)
+
+  @property
+  def lens(self): return self._lens
+
+  def epoch(self, batch_size):
+    '''indices of the batches of one pass. With boundaries, sequences are
+    grouped into buckets by their number of steps, the same way as
+    bucket_by_sequence_length on the queue and tf.data paths.'''
+    if self._shuffle: order = np.random.permutation(len(self))
+    else: order = np.arange(len(self))
+    if not self._boundaries:
+      return [ order[i:i+batch_size]
+               for i in range(0, len(order)-batch_size+1, batch_size) ]
+    steps = self._lens[order]-self._step_offset
+    bucket = np.searchsorted(self._boundaries, steps, side='right')
+    order = order[np.argsort(bucket, kind='stable')]
+    splits = np.searchsorted(np.sort(bucket), np.arange(1, len(self._boundaries)+1))
+    batches = [ group[i:i+batch_size] for group in np.split(order, splits)
+                for i in range(0, len(group), batch_size) ]
+    if self._shuffle: np.random.shuffle(batches)
+    return batches
+
+  def next_batch(self, batch_size):
+    '''next batch of sequences, a new pass starts when all are used'''
+    if not self._batches:
+      self._batches = self.epoch(batch_size)[::-1]
+    return self.gather(self._batches.pop())
+
+  def sequences(self, idx):
+    '''sequences of given indices as a list of arrays'''
+    return [ np.asarray(self._ids[st:st+l])
+             for st, l in zip(self._starts[idx], self._lens[idx]) ]
+
+  def gather(self, idx):
+    '''sequences of given indices padded with 0, and their lengths'''
+    lens = self._lens[idx]
+    steps = np.arange(lens.max())
+    mask = steps < lens[:, None]
+    batch = np.zeros(mask.shape, dtype=np.int64)
+    batch[mask] = self._ids[(self._starts[idx][:, None]+steps)[mask]]
+    return batch, lens
+
+class TreeData(object):
+
+  '''paths of dependency trees, the paths of a tree being consecutive
+  sequences of RaggedData. Trees without any path of two words, like the
+  empty groups parse.py writes for sentences without paths, have nothing
+  to predict and are never sampled.'''
+
+  def __init__(self, data, groups, shuffle=True):
+    self._data = data
+    self._groups = groups
+    self._shuffle = shuffle
+    self._order = []
+    edges = np.concatenate([[0], np.cumsum(data.lens >= 2)])
+    self._trees = np.flatnonzero(edges[groups[1:]] > edges[groups[:-1]])
+
+  def __len__(self): return len(self._trees)
+
+  def next_batch(self, batch_size):
+    '''paths of the next batch_size trees as a list of arrays'''
+    if len(self._order) < batch_size:
+      if self._shuffle: self._order = np.random.permutation(self._trees)
+      else: self._order = self._trees
+    trees, self._order = self._order[:batch_size], self._order[batch_size:]
+    idx = np.concatenate([ np.arange(self._groups[t], self._groups[t+1])
+                           for t in trees ])
+    return self._data.sequences(idx)
+
+def load_ragged(prefix, books=None, trees=False, **kwargs):
+  '''sequences memory-mapped from PREFIX.ids.npy and PREFIX.offsets.npy
+  written by parse.py --ragged, books gives the range of books to be used.
+  With trees, the sequences are grouped by PREFIX.groups.npy.'''
+  ids = np.load(prefix+'.ids.npy', mmap_mode='r')
+  offsets = np.load(prefix+'.offsets.npy')
+  if trees: groups = np.load(prefix+'.groups.npy')
+  if books is not None:
+    book_idx = np.load(prefix+'.books.npy')
+    st, ed = book_idx[books[0]], book_idx[books[1]]
+    offsets = offsets[st:ed+1]
+    if trees: groups = groups[(groups >= st) & (groups <= ed)]-st
+  if trees:
+    shuffle = kwargs.pop('shuffle', True)
+    return TreeData(RaggedData(ids, offsets, **kwargs), groups, shuffle)
+  return RaggedData(ids, offsets, **kwargs)
+
+def load_records(files, **kwargs):
+  '''sequences read into memory from TFRecorder files'''
+  seqs = [ tf.train.Example.FromString(record).features.feature['content']
+           .int64_list.value for f in files
+           for record in tf.python_io.tf_record_iterator(f) ]
+  offsets = np.cumsum([0]+[ len(seq) for seq in seqs ])
+  ids = np.fromiter(itertools.chain.from_iterable(seqs), dtype=np.int64,
+                    count=offsets[-1])
+  return RaggedData(ids, offsets, **kwargs)
+
+def get_ragged_data(para):
+  '''sequences of the split given by para.mode'''
+  if is_test(para.mode):
+    if para.ragged:
+      return load_ragged('testing_data', shuffle=False)
+    return load_records(filenames[2], shuffle=False)
+  #buckets hold the same numbers of steps as bucket_by_sequence_length
+  step_offset = 2 if para.use_bi else 1
+  if is_train(para.mode):
+    return load_ragged(para.data_dir+'train', (0, para.train_num),
+                       trees=para.trie, boundaries=para.bucket_boundaries,
+                       step_offset=step_offset)
+  return load_ragged(para.data_dir+'train', (para.train_num, 522),
+                     trees=para.trie, boundaries=para.bucket_boundaries,
+                     step_offset=step_offset)
+
+def build_trie(seqs):
+  '''prefix trie of sequences. Nodes are the distinct input prefixes,
+  ordered by depth, with the word each one adds and the index of its
+  parent (-1 for roots). Each edge predicts a target word from a node and
+  is weighted by the number of sequences having it at that position, so
+  that the weighted loss over edges is the loss over all sequences.'''
+  index, edges = {}, Counter()
+  parents, words, depths = [], [], []
+  for seq in seqs:
+    node = -1
+    for j in range(len(seq)-1):
+      key = (node, seq[j])
+      if key not in index:
+        index[key] = len(words)
+        parents.append(node)
+        words.append(seq[j])
+        depths.append(j)
+      node = index[key]
+      edges[(node, seq[j+1])] += 1
+
+  #renumber nodes level by level
+  order = np.argsort(depths, kind='stable')
+  renum = np.empty(len(order)+1, dtype=np.int32)
+  renum[order] = np.arange(len(order))
+  renum[-1] = -1
+  edge_nodes, edge_targets = zip(*edges.keys())
+  return {'node_parent': renum[np.array(parents)[order]],
+          'node_word': np.array(words, dtype=np.int64)[order],
+          'levels': np.searchsorted(np.array(depths)[order],
+                                    np.arange(max(depths)+2)).astype(np.int32),
+          'edge_node': renum[list(edge_nodes)],
+          'edge_target': np.array(edge_targets, dtype=np.int64),
+          'edge_weight': np.array(list(edges.values()), dtype=np.float32)}
+
+def split_shared_prefix(inps, tgts):
+  '''split inputs of candidates into the prefix shared by all of them and
+  their own suffixes. Sequences are padded to at least one step, the
+  steps beyond prefix_len or suffix_len are masked out in the graph.'''
+  prefix_len = min(len(inp) for inp in inps)
+  for j in range(prefix_len):
+    if any(inp[j] != inps[0][j] for inp in inps[1:]):
+      prefix_len = j
+      break
+  suffix_steps = max(len(inp) for inp in inps)-prefix_len
+  def pad(seqs, steps):
+    padded = np.zeros([len(seqs), max(steps, 1)], dtype=np.int64)
+    for k, seq in enumerate(seqs): padded[k, :len(seq)] = seq
+    return padded
+  return {'prefix': pad([inps[0][:prefix_len]], prefix_len),
+          'prefix_len': prefix_len,
+          'prefix_target': pad([ tgt[:prefix_len] for tgt in tgts ],
+                               prefix_len),
+          'suffix': pad([ inp[prefix_len:] for inp in inps ], suffix_steps),
+          'suffix_len': [ len(inp)-prefix_len for inp in inps ],
+          'suffix_target': pad([ tgt[prefix_len:] for tgt in tgts ],
+                               suffix_steps)}
+
+def target_log_prob(output, targets, softmax_w, softmax_b):
+  '''log-probabilities of targets without softmax over the vocabulary.
+  output is [n, hidden_size], targets is [..., n] so that each output may
+  have several candidate targets.'''
+  logits = tf.matmul(output, tf.transpose(softmax_w))+softmax_b
+  target_logits = tf.reduce_sum(output*tf.gather(softmax_w, targets), -1)\
+                  +tf.gather(softmax_b, targets)
+  return target_logits-tf.reduce_logsumexp(logits, 1)
+
+def embedding(para):
+  '''pre-trained word embedding shared by the graphs of all modes. It is not
+  trained and is assigned from wordvec by embedding_init. As a local
+  variable it is left out of checkpoints, which keep restoring whatever
+  the embedding variables of older versions were named.'''
+  return tf.get_variable('W_E', [para.vocab_size, para.embed_dim],
+      dtype=tf.float16 if para.half_embedding else tf.float32,
+      initializer=tf.zeros_initializer(), trainable=False,
+      collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+def embedding_init(W_E):
+  '''placeholders of a first row and a chunk of rows of the embedding, and
+  the op assigning the chunk to W_E from that row'''
+  start = tf.placeholder(tf.int32, [])
+  value = tf.placeholder(W_E.dtype, [None, W_E.get_shape()[1]])
+  rows = tf.range(start, start+tf.shape(value)[0])
+  return start, value, tf.scatter_update(W_E, rows, value)
+
+def embed(W_E, ids):
+  '''vectors of word ids as float32'''
+  return tf.to_float(tf.nn.embedding_lookup(W_E, ids))
+
+class TwoLevelSoftmax(object):
+
+  '''softmax factorized into a softmax over clusters of words and a softmax
+  over the words of the target's cluster. Clusters are contiguous ranges of
+  word ids, which parse.py assigns in the frequency order of glove files, so
+  frequent words share clusters. Probabilities are exact and cost
+  O(num_clusters+cluster_size) per word instead of O(vocab_size).'''
+
+  def __init__(self, vocab_size, hidden_size, num_clusters):
+    num_clusters = num_clusters or int(np.ceil(np.sqrt(vocab_size)))
+    self._cluster_size = -(-vocab_size // num_clusters)
+    #clusters past the vocabulary would be empty but still take probability
+    #mass, as many as needed are kept
+    self._num_clusters = -(-vocab_size // self._cluster_size)
+    shape = [self._num_clusters, self._cluster_size]
+    self._cluster_w = tf.get_variable('cluster_w',
+        [self._num_clusters, hidden_size], dtype=tf.float32)
+    self._cluster_b = tf.get_variable('cluster_b', [self._num_clusters],
+        dtype=tf.float32)
+    self._w = tf.get_variable('w', shape+[hidden_size], dtype=tf.float32)
+    self._b = tf.get_variable('b', shape, dtype=tf.float32)
+    #ids beyond vocab_size only pad the last cluster
+    mask = np.zeros(shape, dtype=np.float32)
+    mask.flat[vocab_size:] = -np.inf
+    self._mask = tf.constant(mask)
+
+  def log_prob(self, output, targets):
+    '''log-probabilities of targets, output is [n, hidden_size] and targets
+    is [..., n] like target_log_prob'''
+    if targets.get_shape().ndims == 1:
+      return self._flat_log_prob(output, targets)
+    flat = tf.reshape(targets, [-1])
+    rows = tf.tile(tf.range(tf.shape(output)[0]),
+                   [tf.size(flat)//tf.shape(output)[0]])
+    return tf.reshape(self._flat_log_prob(tf.gather(output, rows), flat),
+                      tf.shape(targets))
+
+  def _flat_log_prob(self, output, targets):
+    targets = tf.to_int32(targets)
+    clusters = targets//self._cluster_size
+    words = targets%self._cluster_size
+    n = tf.shape(output)[0]
+
+    cluster_logits = tf.matmul(output, self._cluster_w, transpose_b=True)\
+                     +self._cluster_b
+    log_prob = tf.gather_nd(cluster_logits, tf.stack([tf.range(n), clusters], 1))\
+               -tf.reduce_logsumexp(cluster_logits, 1)
+
+    #words are scored one cluster at a time, only clusters of targets
+    #are visited
+    used, _ = tf.unique(clusters)
+    def body(i, rows_ta, word_ta):
+      idx = tf.to_int32(tf.where(tf.equal(clusters, used[i]))[:, 0])
+      logits = tf.matmul(tf.gather(output, idx),
+                         tf.gather(self._w, used[i]), transpose_b=True)\
+               +tf.gather(self._b, used[i])+tf.gather(self._mask, used[i])
+      word_log_prob = tf.gather_nd(logits, tf.stack([tf.range(tf.size(idx)),
+                                   tf.gather(words, idx)], 1))\
+                      -tf.reduce_logsumexp(logits, 1)
+      return i+1, rows_ta.write(i, idx), word_ta.write(i, word_log_prob)
+    _, rows_ta, word_ta = tf.while_loop(lambda i, *_: i < tf.size(used), body,
+        [tf.constant(0),
+         tf.TensorArray(tf.int32, size=tf.size(used), infer_shape=False),
+         tf.TensorArray(tf.float32, size=tf.size(used), infer_shape=False)])
+    return log_prob+tf.unsorted_segment_sum(word_ta.concat(), rows_ta.concat(), n)
+
 class DepRNN(object):
 
   '''dependency-tree based rnn'''
 
   def __init__(self, para):
     '''build multi-layer rnn graph'''
+    self._para = para
     if para.rnn_type == 0:#basic rnn
       def unit_cell():
         return tf.contrib.rnn.BasicRNNCell(para.hidden_size, activation=tf.tanh)
@@ -202,19 +510,72 @@ class DepRNN(object):
         state_is_tuple=True)
 
     #using pre-trained word embedding
-    W_E = tf.Variable(tf.constant(0.0,
-        shape=[para.vocab_size, para.embed_dim]), trainable=False, name='W_E')
-    self._embedding = tf.placeholder(tf.float32,
-                                     [para.vocab_size, para.embed_dim])
-    self._embed_init = W_E.assign(self._embedding)
+    W_E = embedding(para)
+
+    with tf.variable_scope('softmax'):
+      if para.softmax_loss == 3:
+        self._hsm = TwoLevelSoftmax(para.vocab_size, para.hidden_size,
+                                    para.num_clusters)
+      else:
+        self._softmax_w = tf.get_variable('w',
+            [para.vocab_size, para.hidden_size], dtype=tf.float32)
+        self._softmax_b = tf.get_variable('b', [para.vocab_size],
+            dtype=tf.float32)
+
+    #score candidates sharing everything but the blank
+    if is_test(para.mode) and para.share_prefix:
+      self._data = get_ragged_data(para)
+      if para.use_bi:
+        scopes = ['bidirectional_rnn/fw', 'bidirectional_rnn/bw']
+      else:
+        scopes = ['rnn']
+      self._prefix_phs, scores = [], []
+      for scope in scopes:
+        phs, score = self._shared_prefix_scores(para, cell, W_E, scope)
+        self._prefix_phs.append(phs)
+        scores.append(score)
+      self._scores = tf.add_n(scores)
+      return
+
+    #train on the tries of whole trees
+    if para.trie and not is_test(para.mode):
+      self._data = get_ragged_data(para)
+      self._cost = self._trie_cost(para, cell, W_E)
+      #nodes of a trie are evaluated level by level without paddings
+      self._pad_eff = tf.constant(1.0)
+      if is_train(para.mode): self._build_eval(para)
+      return
 
     #feed in data in batches
-    one_sent, sq_len = get_single_example(para)
-    batch, seq_len = tf.train.batch([one_sent, sq_len],
-        batch_size=para.batch_size, dynamic_pad=True)
+    self._data = None
+    if para.ragged:
+      self._data = get_ragged_data(para)
+      self._batch = batch = tf.placeholder(tf.int64, [None, None])
+      self._len = tf.placeholder(tf.int64, [None])
+      seq_len = self._len-2 if para.use_bi else self._len-1
+    elif para.tf_data:
+      def parse(serialized_example):
+        one_sent, sq_len = parse_example(para, serialized_example)
+        return tf.sparse_tensor_to_dense(one_sent), sq_len
+      batch, seq_len = tf_input.batch(filenames[para.mode], parse,
+          para.batch_size, shuffle=not is_test(para.mode),
+          cache=para.cache_data,
+          boundaries=None if is_test(para.mode) else para.bucket_boundaries,
+          length=lambda example: example[1])
+    else:
+      one_sent, sq_len = get_single_example(para)
+      if para.bucket_boundaries and not is_test(para.mode):
+        #group sentences of similar length into the same batch
+        _, (batch, seq_len) = tf.contrib.training.bucket_by_sequence_length(
+            tf.to_int32(sq_len), [tf.sparse_tensor_to_dense(one_sent), sq_len],
+            batch_size=para.batch_size,
+            bucket_boundaries=para.bucket_boundaries, dynamic_pad=True)
+      else:
+        batch, seq_len = tf.train.batch([one_sent, sq_len],
+            batch_size=para.batch_size, dynamic_pad=True)
 
-    #sparse tensor cannot be sliced
-    batch = tf.sparse_tensor_to_dense(batch)
+        #sparse tensor cannot be sliced
+        batch = tf.sparse_tensor_to_dense(batch)
 
     #seq_len is for dynamic_rnn
     seq_len = tf.to_int32(seq_len)
@@ -228,8 +589,12 @@ class DepRNN(object):
       inputs = batch[:, :-1]
       self._f_target = batch[:, 1:]
 
+    #ratio of real time steps to all time steps including paddings
+    self._num_words = tf.reduce_sum(seq_len)
+    self._pad_eff = tf.to_float(self._num_words)/tf.to_float(tf.size(inputs))
+
     #word_id to vector
-    inputs = tf.nn.embedding_lookup(W_E, inputs)
+    inputs = embed(W_E, inputs)
 
     if is_train(para.mode) and para.keep_prob < 1:
       inputs = tf.nn.dropout(inputs, para.keep_prob)
@@ -245,132 +610,331 @@ class DepRNN(object):
       output = tf.reshape(outputs, [-1, para.hidden_size])
 
     if is_test(para.mode):
-      with tf.variable_scope('softmax'):
-        softmax_w = tf.get_variable('w', [para.vocab_size, para.hidden_size],
-            dtype=tf.float32)
-        softmax_b = tf.get_variable('b', [para.vocab_size], dtype=tf.float32)
-      logits = tf.matmul(output, tf.transpose(softmax_w))+softmax_b
-      self._prob = tf.nn.softmax(logits)
+      if para.use_bi:
+        targets = tf.concat([self._f_target, self._b_target], 0)
+      else:
+        targets = self._f_target
+      targets = tf.reshape(targets, [-1])
 
-    else:
-      with tf.variable_scope('softmax'):
-        softmax_w = tf.get_variable('w', [para.vocab_size, para.hidden_size],
-            dtype=tf.float32)
-        softmax_b = tf.get_variable('b', [para.vocab_size], dtype=tf.float32)
+      #log-probabilities of target words only, no softmax over vocabulary
+      log_prob = self._log_prob(output, targets)
+
+      #scores of candidates, summed over the real time steps of each and
+      #directions, paddings of shorter candidates are masked out
+      log_prob = tf.reshape(log_prob, [-1, para.batch_size,
+                                       tf.shape(self._f_target)[1]])
+      mask = tf.sequence_mask(seq_len, tf.shape(self._f_target)[1],
+                              dtype=tf.float32)
+      self._scores = tf.reduce_sum(log_prob*mask, [0, 2])
 
+    else:
+      #paddings are masked out, the cost is the mean over real tokens
+      #however sentences are batched or bucketed
+      mask = tf.reshape(tf.sequence_mask(seq_len, tf.shape(self._f_target)[1],
+                                         dtype=tf.float32), [-1])
       if para.use_bi:
-        loss = softmax[args.softmax_loss](softmax_w, softmax_b,
-               tf.reshape(tf.concat([self._f_target, self._b_target],1), [-1,1]),
-               output, num_sampled=para.num_sampled, num_classes=para.vocab_size)
+        #rows of output are all forward steps, then all backward steps
+        labels = tf.concat([self._f_target, self._b_target], 0)
+        mask = tf.concat([mask, mask], 0)
       else:
-        loss = softmax[args.softmax_loss](softmax_w, softmax_b,
-               tf.reshape(self._f_target, [-1, 1]), output,
-               num_sampled=para.num_sampled, num_classes=para.vocab_size)
+        labels = self._f_target
+      loss = self._loss(tf.reshape(labels, [-1, 1]), output)
 
-      self._cost = cost = tf.reduce_mean(loss)
+      self._cost = tf.reduce_sum(loss*mask)/tf.reduce_sum(mask)
 
     #if validation or testing, exit here
     if not is_train(para.mode): return
-
+    self._build_eval(para)
+
+  def _loss(self, labels, output):
+    '''training loss of each row of output, labels is [n, 1]'''
+    para = self._para
+    if para.softmax_loss == 3:
+      return -self._hsm.log_prob(output, tf.reshape(labels, [-1]))
+    return softmax[para.softmax_loss](self._softmax_w, self._softmax_b,
+           labels, output, num_sampled=para.num_sampled,
+           num_classes=para.vocab_size)
+
+  def _log_prob(self, output, targets):
+    '''exact log-probabilities of targets, see target_log_prob'''
+    if self._para.softmax_loss == 3:
+      return self._hsm.log_prob(output, targets)
+    return target_log_prob(output, targets, self._softmax_w, self._softmax_b)
+
+  def _build_eval(self, para):
+    '''optimizer step on the cost'''
     #clip global gradient norm
     tvars = tf.trainable_variables()
-    grads, _ = tf.clip_by_global_norm(tf.gradients(cost, tvars),
+    grads, _ = tf.clip_by_global_norm(tf.gradients(self._cost, tvars),
                para.max_grad_norm)
     optimizer = optimizers[para.optimizer](para.learning_rate)
     self._eval = optimizer.apply_gradients(zip(grads, tvars),
                  global_step=tf.contrib.framework.get_or_create_global_step())
 
+  def _trie_cost(self, para, cell, W_E):
+    '''loss over the edges of a trie built by build_trie. The rnn is run
+    one level at a time, each node starting from the state of its parent,
+    so a prefix shared by several paths is computed only once. The cost is
+    the mean loss over the real tokens of the paths, like the masked cost
+    of flat batches.'''
+    self._trie_phs = phs = {
+        'node_parent': tf.placeholder(tf.int32, [None]),
+        'node_word': tf.placeholder(tf.int64, [None]),
+        'levels': tf.placeholder(tf.int32, [None]),
+        'edge_node': tf.placeholder(tf.int32, [None]),
+        'edge_target': tf.placeholder(tf.int64, [None]),
+        'edge_weight': tf.placeholder(tf.float32, [None])}
+
+    #parents of a level are all in the previous one, so only its states are
+    #kept. Level -1 is the zero state of roots, which start at row 0 of it.
+    prev_start = tf.concat([[-1], phs['levels']], 0)
+    zero_state = nest.flatten(cell.zero_state(1, tf.float32))
+    def body(level, states, outputs):
+      st, ed = phs['levels'][level], phs['levels'][level+1]
+      parents = phs['node_parent'][st:ed]-prev_start[level]
+      state = nest.pack_sequence_as(cell.state_size,
+          [ tf.gather(s, parents) for s in states ])
+      inputs = embed(W_E, phs['node_word'][st:ed])
+      if is_train(para.mode) and para.keep_prob < 1:
+        inputs = tf.nn.dropout(inputs, para.keep_prob)
+      output, state = cell(inputs, state)
+      return level+1, nest.flatten(state), outputs.write(level, output)
+
+    num_levels = tf.size(phs['levels'])-1
+    with tf.variable_scope('rnn'):
+      _, _, outputs = tf.while_loop(
+          lambda level, states, outputs: level < num_levels,
+          body, [tf.constant(0), zero_state,
+                 tf.TensorArray(tf.float32, size=num_levels,
+                                infer_shape=False)],
+          shape_invariants=[tf.TensorShape([]),
+                            [ tf.TensorShape([None, s.get_shape()[1]])
+                              for s in zero_state ],
+                            tf.TensorShape(None)])
+    #outputs of all nodes in the order of build_trie
+    outputs = outputs.concat()
+    outputs.set_shape([None, para.hidden_size])
+
+    loss = self._loss(tf.reshape(phs['edge_target'], [-1, 1]),
+                      tf.gather(outputs, phs['edge_node']))
+    self._num_words = tf.to_int32(tf.reduce_sum(phs['edge_weight']))
+    return tf.reduce_sum(loss*phs['edge_weight'])\
+           /tf.reduce_sum(phs['edge_weight'])
+
+  def _shared_prefix_scores(self, para, cell, W_E, scope):
+    '''scores of candidates in one direction. The shared prefix is run once
+    and its final state is branched to the suffix of every candidate.'''
+    phs = {'prefix': tf.placeholder(tf.int64, [1, None]),
+           'prefix_len': tf.placeholder(tf.int32, []),
+           'prefix_target': tf.placeholder(tf.int64, [para.batch_size, None]),
+           'suffix': tf.placeholder(tf.int64, [para.batch_size, None]),
+           'suffix_len': tf.placeholder(tf.int32, [para.batch_size]),
+           'suffix_target': tf.placeholder(tf.int64, [para.batch_size, None])}
+
+    prefix_out, state = tf.nn.dynamic_rnn(cell,
+        embed(W_E, phs['prefix']),
+        sequence_length=tf.reshape(phs['prefix_len'], [1]),
+        dtype=tf.float32, scope=scope)
+    state = nest.pack_sequence_as(state, [ tf.tile(st, [para.batch_size, 1])
+                                           for st in nest.flatten(state) ])
+    #the cell variables were created by the prefix when there is no
+    #training graph
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      suffix_out, _ = tf.nn.dynamic_rnn(cell,
+          embed(W_E, phs['suffix']),
+          sequence_length=phs['suffix_len'], initial_state=state,
+          scope=scope)
+
+    #outputs of prefix are shared, only the target after it differs
+    prefix_out = tf.reshape(prefix_out, [-1, para.hidden_size])
+    prefix_log_prob = self._log_prob(prefix_out, phs['prefix_target'])
+    prefix_mask = tf.sequence_mask(tf.reshape(phs['prefix_len'], [1]),
+                                   tf.shape(prefix_out)[0], dtype=tf.float32)
+
+    suffix_out = tf.reshape(suffix_out, [-1, para.hidden_size])
+    suffix_log_prob = self._log_prob(suffix_out,
+                                     tf.reshape(phs['suffix_target'], [-1]))
+    suffix_log_prob = tf.reshape(suffix_log_prob, [para.batch_size, -1])
+    suffix_mask = tf.sequence_mask(phs['suffix_len'],
+                                   tf.shape(suffix_log_prob)[1],
+                                   dtype=tf.float32)
+
+    return phs, tf.reduce_sum(prefix_log_prob*prefix_mask, 1)\
+                +tf.reduce_sum(suffix_log_prob*suffix_mask, 1)
+
+  def feed_dict(self):
+    '''next batch to be fed, empty if data come from queue runners'''
+    if self._data is None: return {}
+    if self._para.trie and not is_test(self._para.mode):
+      trie = build_trie(self._data.next_batch(self._para.batch_size))
+      return { ph: trie[key] for key, ph in self._trie_phs.items() }
+    batch, lens = self._data.next_batch(self._para.batch_size)
+    if not is_test(self._para.mode) or not self._para.share_prefix:
+      return {self._batch: batch, self._len: lens}
+
+    seqs = [ batch[k, :lens[k]] for k in range(len(lens)) ]
+    if self._para.use_bi:
+      splits = [split_shared_prefix([ seq[1:-1] for seq in seqs ],
+                                    [ seq[2:] for seq in seqs ]),
+                split_shared_prefix([ seq[1:-1][::-1] for seq in seqs ],
+                                    [ seq[:-2][::-1] for seq in seqs ])]
+    else:
+      splits = [split_shared_prefix([ seq[:-1] for seq in seqs ],
+                                    [ seq[1:] for seq in seqs ])]
+    feed = {}
+    for phs, split in zip(self._prefix_phs, splits):
+      for key, ph in phs.items():
+        feed[ph] = split[key]
+    return feed
+
   @property
   def cost(self): return self._cost
   @property
   def eval(self): return self._eval
   @property
-  def prob(self): return self._prob
+  def scores(self): return self._scores
+  @property
+  def pad_eff(self): return self._pad_eff
+  @property
+  def num_words(self): return self._num_words
   @property
   def f_target(self): return self._f_target
   @property
   def b_target(self): return self._b_target
   @property
   def output(self): return self._output
-  @property
-  def embedding(self): return self._embedding
 
 def run_epoch(sess, model, args):
   '''Runs the model on the given data.'''
   fetches = {}
   if not is_test(args.mode):
     fetches['cost'] = model.cost
+    fetches['pad_eff'] = model.pad_eff
+    fetches['num_words'] = model.num_words
     if is_train(args.mode):
       fetches['eval'] = model.eval
 
-    vals = sess.run(fetches)
-    return np.exp(vals['cost'])
+    vals = sess.run(fetches, feed_dict=model.feed_dict())
+    return np.exp(vals['cost']), vals['pad_eff'], vals['num_words']
 
   else:
-    fetches['prob'] = model.prob
-    fetches['f_target'] = model.f_target
-    if args.use_bi: fetches['b_target'] = model.b_target
-
-    vals = sess.run(fetches)
-    prob = vals['prob']
-    f_target = vals['f_target']
-    if args.use_bi: b_target = vals['b_target']
-
-    #shape of choices = 5 x (len(sentence)-1)
-    sent_len = f_target.shape[1]
-    f_choices = np.array([[prob[k*sent_len+j, f_target[k, j]]
-        for j in range(sent_len)] for k in range(5)])
-
-    if not args.use_bi:
-      return chr(ord('a')+np.argmax(np.sum(np.log(f_choices), axis=1)))
-
-    b_choices = np.array([[prob[(5+k)*sent_len+j, b_target[k, j]]
-        for j in range(sent_len)] for k in range(5)])
-    return chr(ord('a')+
-           np.argmax(np.sum(np.log(f_choices)+np.log(b_choices), axis=1)))
-
-with tf.Graph().as_default():
-  initializer = tf.random_uniform_initializer(-args.init_scale, args.init_scale)
-
-  #mode: 0->train, 1->valid, 2->test
-  with tf.name_scope('train'):
-    train_args = copy.deepcopy(args)
-    with tf.variable_scope('model', reuse=None, initializer=initializer):
-      train_args.mode = 0
-      train_model = DepRNN(para=train_args)
-  if args.train_num < 522:
-    with tf.name_scope('valid'):
-      valid_args = copy.deepcopy(args)
-      with tf.variable_scope('model', reuse=True, initializer=initializer):
-        valid_args.mode = 1
-        valid_model = DepRNN(para=valid_args)
-  with tf.name_scope('test'):
-    test_args = copy.deepcopy(args)
-    with tf.variable_scope('model', reuse=True, initializer=initializer):
-      test_args.mode = 2
-      test_args.batch_size = 5
-      test_model = DepRNN(para=test_args)
-
-  sv = tf.train.Supervisor(logdir='./logs/')
-  with sv.managed_session() as sess:
-
-    #load in pre-trained word-embedding
-    sess.run(train_model._embed_init,
-             feed_dict={train_model._embedding: wordvec})
-    sess.run(test_model._embed_init,
-             feed_dict={test_model._embedding: wordvec})
-
-    for i in range(1, args.max_epoch+1):
-      train_perplexity = run_epoch(sess, train_model, train_args)
-      if i%args.info_epoch == 0:
-        print('Epoch: %d Train Perplexity: %.4f'%(i, train_perplexity))
+    fetches['scores'] = model.scores
+    vals = sess.run(fetches, feed_dict=model.feed_dict())
+    return vals['scores']
+
+def write_predictions(sess, model, args):
+  '''answer every testing question with its most probable candidate'''
+  with open(args.output_filename, 'w') as f:
+    wrtr = csv.writer(f)
+    wrtr.writerow(['id', 'answer'])
+    for i in range(1040):
+      scores = run_epoch(sess, model, args)
+      wrtr.writerow([i+1, chr(ord('a')+np.argmax(scores))])
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  if args.trie and (not args.use_dep or not args.ragged or args.use_bi):
+    parser.error('--trie needs --use_dep and --ragged without --use_bi')
+  if args.num_clusters < 0:
+    parser.error('--num_clusters must not be negative')
+  if args.max_epoch == 0:
+    args.inference_only = True
+
+  #calculate real epochs
+  print('training with about %.3f epochs!'
+        %((args.batch_size*args.max_epoch)/2100000))
+
+  #memory-map pre-trained word embedding, it is read once into W_E
+  wordvec = np.load('data/wordvec.'+src_name[args.wordvec_src]+'.npy',
+                    mmap_mode='r')
+
+  #decide vocab_size and embed_dim
+  args.vocab_size, args.embed_dim = wordvec.shape
+  print('vocab_size = %d'%args.vocab_size)
+  print('word embedding dimension = %d'%args.embed_dim)
+
+  #load in file list for training and validation
+  filenames = open('training_list', 'r').read().splitlines()
+  filenames = [ args.data_dir+ff[21:-4]+'.tfr' for ff in filenames ]
+  assert len(filenames) == 522
+  filenames = [filenames[:default_train_num], filenames[default_train_num:],
+      ['testing_data.tfr']]
+
+  with tf.Graph().as_default():
+    initializer = tf.random_uniform_initializer(-args.init_scale, args.init_scale)
+
+    #mode: 0->train, 1->valid, 2->test
+    if not args.inference_only:
+      with tf.name_scope('train'):
+        train_args = copy.deepcopy(args)
+        with tf.variable_scope('model', reuse=None, initializer=initializer):
+          train_args.mode = 0
+          train_model = DepRNN(para=train_args)
       if args.train_num < 522:
-        valid_perplexity = run_epoch(sess, valid_model, valid_args)
-        if i%args.info_epoch == 0:
-          print('Epoch: %d Valid Perplexity: %.4f'%(i, valid_perplexity))
-    with open(args.output_filename, 'w') as f:
-      wrtr = csv.writer(f)
-      wrtr.writerow(['id', 'answer'])
-      for i in range(1040):
-        result = run_epoch(sess, test_model, test_args)
-        wrtr.writerow([i+1, result])
+        with tf.name_scope('valid'):
+          valid_args = copy.deepcopy(args)
+          with tf.variable_scope('model', reuse=True, initializer=initializer):
+            valid_args.mode = 1
+            valid_model = DepRNN(para=valid_args)
+    with tf.name_scope('test'):
+      test_args = copy.deepcopy(args)
+      #without the training graph, the testing graph creates the variables
+      with tf.variable_scope('model', reuse=None if args.inference_only else True,
+                             initializer=initializer):
+        test_args.mode = 2
+        test_args.batch_size = 5
+        test_model = DepRNN(para=test_args)
+
+    #the one W_E shared by all graphs is filled once from the memory-mapped file
+    with tf.variable_scope('model', reuse=True):
+      W_E = embedding(args)
+      embed_start, embed_value, embed_init = embedding_init(W_E)
+    def load_embedding(sess, chunk_rows=1<<16):
+      #rows are converted to the dtype of W_E chunk by chunk, wordvec is never
+      #copied as a whole
+      sess.run(W_E.initializer)
+      dtype = embed_value.dtype.as_numpy_dtype
+      for st in range(0, len(wordvec), chunk_rows):
+        sess.run(embed_init, feed_dict={embed_start: st, embed_value:
+                 np.asarray(wordvec[st:st+chunk_rows], dtype=dtype)})
+
+    if args.inference_only:
+      #only the trained weights are restored, W_E is loaded from wordvec and
+      #./logs/ is left untouched
+      checkpoint = tf.train.latest_checkpoint('./logs/')
+      if checkpoint is None:
+        sys.exit('no checkpoint found in ./logs/')
+      saver = tf.train.Saver(tf.trainable_variables())
+      with tf.Session() as sess:
+        saver.restore(sess, checkpoint)
+        load_embedding(sess)
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+        write_predictions(sess, test_model, test_args)
+        coord.request_stop()
+        coord.join(threads)
+    else:
+      sv = tf.train.Supervisor(logdir='./logs/')
+      with sv.managed_session() as sess:
+
+        #load in pre-trained word-embedding
+        load_embedding(sess)
+
+        pad_effs, num_words, train_time = [], 0, 0.
+        for i in range(1, args.max_epoch+1):
+          start_time = time.time()
+          train_perplexity, pad_eff, words = run_epoch(sess, train_model,
+                                                       train_args)
+          train_time += time.time()-start_time
+          pad_effs.append(pad_eff)
+          num_words += words
+          if i%args.info_epoch == 0:
+            print('Epoch: %d Train Perplexity: %.4f'%(i, train_perplexity))
+            print('Padding Efficiency: %.2f%% Speed: %.0f words/sec'
+                  %(100*np.mean(pad_effs), num_words/train_time))
+            pad_effs, num_words, train_time = [], 0, 0.
+          if args.train_num < 522:
+            valid_perplexity, _, _ = run_epoch(sess, valid_model, valid_args)
+            if i%args.info_epoch == 0:
+              print('Epoch: %d Valid Perplexity: %.4f'%(i, valid_perplexity))
+        write_predictions(sess, test_model, test_args)
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+'''Binary store of GloVe word vectors.
+
+A glove.*.txt file is converted once into a word list (one word per line)
+and a float32 .npy matrix, the i-th row being the vector of the i-th word.
+Loading memory-maps the matrix, so only the rows actually used are read.
+'''
+import argparse
+import os, re, sys
+import numpy as np
+from tqdm import tqdm
+
+def store_names(glove_file):
+  '''names of the word list and the matrix of given glove file'''
+  base = re.sub(r'\.txt$', '', glove_file)
+  return base + '.words.txt', base + '.npy'
+
+def convert(glove_file):
+  '''convert glove_file in text format into a binary store. A word appearing
+  more than once keeps its last vector, as a dict built from the file would,
+  so words and rows stay one-to-one.'''
+  vocab_name, matrix_name = store_names(glove_file)
+  # newline='\n' is needed since some glove words contain other line breaks
+  last = dict()
+  with open(glove_file, 'r', encoding='utf-8', newline='\n') as glove:
+    for i, line in enumerate(glove):
+      if i == 0:
+        dimension = len(line.rstrip().split(' ')) - 1
+      # split from right, a few words of glove.840B contain spaces
+      last[line.rstrip().rsplit(' ', dimension)[0]] = i
+  line_num = i + 1
+
+  matrix = np.lib.format.open_memmap(matrix_name, mode='w+',
+                                     dtype=np.float32,
+                                     shape=(len(last), dimension))
+  with open(glove_file, 'r', encoding='utf-8', newline='\n') as glove, \
+       open(vocab_name, 'w', encoding='utf-8', newline='\n') as vocab:
+    row = 0
+    for i, line in enumerate(tqdm(glove, total=line_num)):
+      ret = line.rstrip().rsplit(' ', dimension)
+      if last[ret[0]] != i:
+        continue
+      vocab.write(ret[0] + '\n')
+      matrix[row] = np.array(ret[1:], dtype=np.float32)
+      row += 1
+  matrix.flush()
+  del matrix
+
+class GloveStore(object):
+
+  '''memory-mapped glove vectors with O(1) lookup from word to row'''
+
+  def __init__(self, glove_file):
+    vocab_name, matrix_name = store_names(glove_file)
+    if not os.path.isfile(vocab_name) or not os.path.isfile(matrix_name):
+      sys.stderr.write('converting %s into binary store...\n' % glove_file)
+      convert(glove_file)
+    self._vectors = np.load(matrix_name, mmap_mode='r')
+    with open(vocab_name, 'r', encoding='utf-8', newline='\n') as vocab:
+      self._words = vocab.read().split('\n')[:-1]
+    assert len(self._words) == self._vectors.shape[0]
+    self._index = { word: i for i, word in enumerate(self._words) }
+
+  def __len__(self): return len(self._words)
+  def __contains__(self, word): return word in self._index
+  def __getitem__(self, word): return self._vectors[self._index[word]]
+
+  def index(self, word, default=-1):
+    '''row of given word, default if it is not in the store'''
+    return self._index.get(word, default)
+
+  def rows(self, words):
+    '''vectors of given words in a [len(words), dimension] array'''
+    return np.asarray(self._vectors[[self._index[w] for w in words]])
+
+  @property
+  def words(self): return self._words
+  @property
+  def vectors(self): return self._vectors
+  @property
+  def dimension(self): return self._vectors.shape[1]
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='Converting glove files '
+        'in text format into memory-mappable binary stores.')
+  argparser.add_argument('glove_files', type=str, nargs='+',
+        help='glove files in the format of glove.#B.#d.txt')
+  args = argparser.parse_args()
+  for glove_file in args.glove_files:
+    sys.stderr.write('converting %s...\n' % glove_file)
+    convert(glove_file)
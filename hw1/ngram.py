@@ -1,87 +1,327 @@
-from nltk import ngrams
 import argparse
 import re, string
 import os, sys
+from array import array
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
 
 # output file is ngram_result.npy
+# with --index, the counts are also kept in INDEX/ as
+#   vocab.txt           one word per line, the i-th word has id i
+#   sources.txt         n, name, size and mtime of the training files
+#   order%d.keys.npy    sorted packed k-grams for k = 1..n
+#   order%d.counts.npy  their counts
 
-argparser = argparse.ArgumentParser(description='Calculate probability based on N-gram')
-argparser.add_argument('-i', '--file_list',
-  type=str, default='training_list',
-  help='FILE_LIST is the file storing the file names of training datas.'
-       ' (default: %(default)s)')
-argparser.add_argument('-n', '--ngram_num',
-  type=int, default=3,
-  help='NGRAM_NUM is the number n of ngram, ex. trigram has n = 3')
-argparser.add_argument('-t', '--test_data',
-  type=str, default='testing_data_out.txt',
-  help='TEST_DATA is the file of testing data with underline filled with answers'
-       ' (default: %(default)s)')
-argparser.set_defaults(comma_split=False)
-args = argparser.parse_args()
-
-ngram = []
-
-with open(args.file_list,'r') as file_list:
-  for file_name in file_list:
-    with open(file_name[:-1],'r',encoding="utf-8",errors='ignore') as f:
-      sys.stderr.write('start proccessing file ' + file_name[:-1] + '\n')
-      lines = [l.strip('\n') for l in f.readlines()]
-      if not lines:
-        continue
-      else:
-        for sentence in lines:
-          ngram.extend((ngrams(sentence.split(),
-            args.ngram_num,
-            pad_left=True,
-            pad_right=True,
-            left_pad_symbol='<s>',
-            right_pad_symbol='</s>'
-          )))
-
-# counting ngram appearance
-ngram_dictionary = dict()
-counter = 0
-for g in ngram:
-  counter = counter + 1
-  if ngram_dictionary.get(g, -1) == -1:
-    ngram_dictionary[g] = 1
+# each n-gram is packed into 64-bit words, ID_BITS bits per word id
+ID_BITS = 21
+IDS_PER_KEY = 64 // ID_BITS
+# id of words which never appear in the training data
+UNK_ID = (1 << ID_BITS) - 1
+# number of tokens counted at once before merging into the tables
+CHUNK_TOKENS = 1 << 20
+
+def key_dtype(n):
+  '''dtype of packed n-grams, uint64 when n <= IDS_PER_KEY and a record of
+  several uint64 otherwise, both sorted in the lexicographic order of ids'''
+  words = -(-n // IDS_PER_KEY)
+  if words == 1:
+    return np.dtype(np.uint64)
+  return np.dtype([ ('k%d' % i, np.uint64) for i in range(words) ])
+
+def encode(grams):
+  '''pack a [m, n] array of word ids into m keys'''
+  n = grams.shape[1]
+  dtype = key_dtype(n)
+  words = []
+  for st in range(0, n, IDS_PER_KEY):
+    key = np.zeros(len(grams), dtype=np.uint64)
+    for j in range(st, min(st+IDS_PER_KEY, n)):
+      key = (key << np.uint64(ID_BITS)) | grams[:, j].astype(np.uint64)
+    words.append(key)
+  if dtype.names is None:
+    return words[0]
+  keys = np.empty(len(grams), dtype=dtype)
+  for name, key in zip(dtype.names, words):
+    keys[name] = key
+  return keys
+
+def decode(keys, n):
+  '''unpack keys into a [m, n] array of word ids'''
+  words = [keys] if keys.dtype.names is None else \
+          [ keys[name] for name in keys.dtype.names ]
+  grams = np.empty((len(keys), n), dtype=np.int64)
+  mask = np.uint64(UNK_ID)
+  for i, key in enumerate(words):
+    st = i*IDS_PER_KEY
+    for j in range(min(st+IDS_PER_KEY, n)-1, st-1, -1):
+      grams[:, j] = key & mask
+      key = key >> np.uint64(ID_BITS)
+  return grams
+
+def sentence_ids(words, vocab, n, grow):
+  '''ids of a sentence padded like nltk.ngrams with pad_left and pad_right.
+  New words are added to vocab if grow, or mapped to UNK_ID otherwise.'''
+  if grow:
+    ids = [ vocab.setdefault(w, len(vocab)) for w in words ]
+  else:
+    ids = [ vocab.get(w, UNK_ID) for w in words ]
+  return [0]*(n-1) + ids + [1]*(n-1)
+
+def gram_ids(tokens, ends, n):
+  '''[m, n] ids of all n-grams of padded sentences concatenated in tokens,
+  the i-th sentence ending before ends[i]'''
+  tokens = np.frombuffer(tokens, dtype=np.int64)
+  ends = np.frombuffer(ends, dtype=np.int64)
+  # an n-gram must not cross the end of its sentence
+  ends = np.repeat(ends, np.diff(ends, prepend=0))
+  starts = np.flatnonzero(np.arange(len(tokens))+n <= ends)
+  return tokens[starts[:, None]+np.arange(n)]
+
+def count_keys(keys):
+  '''sorted distinct keys and their counts'''
+  return np.unique(keys, return_counts=True)
+
+def merge_tables(a, b):
+  '''merge two tables of sorted distinct keys and counts'''
+  keys = np.concatenate([a[0], b[0]])
+  counts = np.concatenate([a[1], b[1]])
+  if len(keys) == 0:
+    return keys, counts
+  order = np.argsort(keys, kind='stable')
+  keys, counts = keys[order], counts[order]
+  first = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+  return keys[first], np.add.reduceat(counts, first)
+
+class NgramCounter(object):
+
+  '''streaming n-gram counter. Tokens are counted in chunks of
+  CHUNK_TOKENS and the tables are merged like a binary counter, so the
+  memory used is bounded by the number of distinct n-grams.
+  Lower orders are counted over the same sentences padded for n, so every
+  suffix of an n-gram is one of the k-grams.'''
+
+  def __init__(self, n, orders=None, vocab=None):
+    self._n = n
+    self._orders = [n] if orders is None else orders
+    self._vocab = { '<s>': 0, '</s>': 1 } if vocab is None else vocab
+    self._tables = { k: [] for k in self._orders }
+    self._tokens = array('q')
+    self._ends = array('q')
+
+  def add(self, words):
+    '''count n-grams of a sentence'''
+    self._tokens.extend(sentence_ids(words, self._vocab, self._n, True))
+    self._ends.append(len(self._tokens))
+    assert len(self._vocab) < UNK_ID, 'too many words for %d bits' % ID_BITS
+    if len(self._tokens) >= CHUNK_TOKENS:
+      self._flush()
+
+  def _flush(self):
+    if not self._ends:
+      return
+    for k in self._orders:
+      self._push(k, count_keys(encode(gram_ids(self._tokens, self._ends, k))))
+    self._tokens, self._ends = array('q'), array('q')
+
+  def _push(self, k, table):
+    tables = self._tables[k]
+    # merge tables of similar sizes, O(log) tables are kept
+    while tables and len(tables[-1][0]) <= 2*len(table[0]):
+      table = merge_tables(tables.pop(), table)
+    tables.append(table)
+
+  def merge(self, words, tables):
+    '''add tables of all orders counted by another counter, whose i-th
+    word is words[i]'''
+    remap = np.array([ self._vocab.setdefault(w, len(self._vocab))
+                       for w in words ], dtype=np.int64)
+    assert len(self._vocab) < UNK_ID, 'too many words for %d bits' % ID_BITS
+    for k, (keys, counts) in tables.items():
+      keys = encode(remap[decode(keys, k)])
+      order = np.argsort(keys, kind='stable')
+      self._push(k, (keys[order], counts[order]))
+
+  def table(self, k=None):
+    '''sorted distinct keys and their counts of the k-grams (n-grams by
+    default) of all sentences added'''
+    self._flush()
+    tables = self._tables[self._n if k is None else k]
+    table = (np.zeros(0, dtype=key_dtype(self._n if k is None else k)),
+             np.zeros(0, dtype=np.int64))
+    while tables:
+      table = merge_tables(tables.pop(), table)
+    tables.append(table)
+    return table
+
+  def tables(self):
+    '''tables of all orders counted, keyed by order'''
+    return { k: self.table(k) for k in self._orders }
+
+  @property
+  def vocab(self): return self._vocab
+  @property
+  def words(self): return sorted(self._vocab, key=self._vocab.get)
+
+def file_sources(file_names, n):
+  '''lines identifying the order and the content of training files'''
+  lines = ['%d-gram\n' % n]
+  for file_name in file_names:
+    st = os.stat(file_name)
+    lines.append('%s\t%d\t%d\n' % (file_name, st.st_size, st.st_mtime_ns))
+  return ''.join(lines)
+
+def save_index(directory, vocab, tables, sources):
+  '''write vocab and count tables of every order into directory'''
+  os.makedirs(directory, exist_ok=True)
+  if os.path.exists(os.path.join(directory, 'sources.txt')):
+    os.remove(os.path.join(directory, 'sources.txt'))
+  for k, (keys, counts) in tables.items():
+    np.save(os.path.join(directory, 'order%d.keys.npy' % k), keys)
+    np.save(os.path.join(directory, 'order%d.counts.npy' % k), counts)
+  words = sorted(vocab, key=vocab.get)
+  with open(os.path.join(directory, 'vocab.txt'), 'w', encoding='utf-8',
+            newline='\n') as f:
+    f.write(''.join(w + '\n' for w in words))
+  # written last, an index without it is incomplete
+  with open(os.path.join(directory, 'sources.txt'), 'w') as f:
+    f.write(sources)
+
+def load_index(directory, n, sources):
+  '''vocab and memory-mapped tables of orders 1..n in directory, None if
+  the index is missing or was built from other files'''
+  try:
+    with open(os.path.join(directory, 'sources.txt'), 'r') as f:
+      if f.read() != sources:
+        return None
+    tables = { k: (np.load(os.path.join(directory, 'order%d.keys.npy' % k),
+                           mmap_mode='r'),
+                   np.load(os.path.join(directory, 'order%d.counts.npy' % k),
+                           mmap_mode='r'))
+               for k in range(1, n+1) }
+  except FileNotFoundError:
+    return None
+  with open(os.path.join(directory, 'vocab.txt'), 'r', encoding='utf-8',
+            newline='\n') as f:
+    vocab = { w: i for i, w in enumerate(f.read().split('\n')[:-1]) }
+  return vocab, tables
+
+def count_file(file_name, counter):
+  '''count n-grams of every line of a training file'''
+  with open(file_name, 'r', encoding="utf-8", errors='ignore') as f:
+    sys.stderr.write('start proccessing file ' + file_name + '\n')
+    for line in f:
+      counter.add(line.strip('\n').split())
+
+def lookup(table, grams):
+  '''probabilities of [m, k] grams in a table of k-grams, nan if unseen'''
+  keys, counts = table
+  queries = encode(grams)
+  idx = np.minimum(np.searchsorted(keys, queries), len(keys)-1)
+  found = keys[idx] == queries
+  return np.where(found, counts[idx] / counts.sum(), np.nan)
+
+def count_book(file_name, n, orders):
+  '''words and tables of all orders of one training file'''
+  counter = NgramCounter(n, orders)
+  count_file(file_name, counter)
+  return counter.words, counter.tables()
+
+def count_files(file_names, n, orders, workers):
+  '''count training files, in a pool of workers if workers > 1. Each
+  worker counts whole files with its own vocabulary, whose ids are mapped
+  to the global ones before the tables are merged.'''
+  counter = NgramCounter(n, orders)
+  if workers <= 1:
+    for file_name in file_names:
+      count_file(file_name, counter)
+    return counter
+  with Pool(workers) as pool:
+    for words, tables in pool.imap(partial(count_book, n=n, orders=orders),
+                                   file_names):
+      counter.merge(words, tables)
+  return counter
+
+def score_sentences(sentences, vocab, tables, n, backoff=None):
+  '''probability of each sentence, the product of the probabilities of its
+  n-grams. Unseen n-grams get the probability of the rarest one, or with
+  backoff, the one of their longest seen suffix times backoff per order
+  dropped.'''
+  minimum_prob = tables[n][1].min() / tables[n][1].sum()
+  tokens, ends = array('q'), array('q')
+  for words in sentences:
+    tokens.extend(sentence_ids(words, vocab, n, False))
+    ends.append(len(tokens))
+  grams = gram_ids(tokens, ends, n)
+  probs = lookup(tables[n], grams)
+  if backoff:
+    for k in range(n-1, 0, -1):
+      unseen = np.flatnonzero(np.isnan(probs))
+      probs[unseen] = lookup(tables[k], grams[unseen, n-k:])*backoff**(n-k)
+  probs[np.isnan(probs)] = minimum_prob
+  # products over the n-grams of each sentence, 1 if it has none
+  grams = np.diff(np.frombuffer(ends, dtype=np.int64), prepend=0)-n+1
+  prob = np.multiply.reduceat(np.append(probs, 1.), np.cumsum(grams)-grams)
+  return np.where(grams > 0, prob, 1.)
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='Calculate probability based on N-gram')
+  argparser.add_argument('-i', '--file_list',
+    type=str, default='training_list',
+    help='FILE_LIST is the file storing the file names of training datas.'
+         ' (default: %(default)s)')
+  argparser.add_argument('-n', '--ngram_num',
+    type=int, default=3,
+    help='NGRAM_NUM is the number n of ngram, ex. trigram has n = 3')
+  argparser.add_argument('-t', '--test_data',
+    type=str, default='testing_data_out.txt',
+    help='TEST_DATA is the file of testing data with underline filled with answers'
+         ' (default: %(default)s)')
+  argparser.add_argument('-x', '--index',
+    type=str, default='',
+    help='INDEX is the directory of the n-gram index. It is built from the '
+         'training files if missing or out of date, and memory-mapped '
+         'otherwise. (default: no index)')
+  argparser.add_argument('-bo', '--backoff',
+    type=float, default=0,
+    help='BACKOFF is the factor applied per order when an unseen n-gram '
+         'falls back to a shorter one, 0 to use the probability of the '
+         'rarest n-gram instead. (default: %(default)s)')
+  argparser.add_argument('-w', '--workers',
+    type=int, default=1,
+    help='WORKERS is the number of processes counting training files in '
+         'parallel. (default: %(default)s)')
+  argparser.set_defaults(comma_split=False)
+  args = argparser.parse_args()
+
+  with open(args.file_list,'r') as file_list:
+    file_names = [ file_name.rstrip('\n') for file_name in file_list ]
+
+  index = None
+  if args.index:
+    sources = file_sources(file_names, args.ngram_num)
+    index = load_index(args.index, args.ngram_num, sources)
+  if index is not None:
+    sys.stderr.write('loaded index ' + args.index + '\n')
+    vocab, tables = index
   else:
-    ngram_dictionary[g] = ngram_dictionary[g] + 1
-
-#counting probability
-minimum_prob = 2 # maximal probability should be 1, initialize to 2 just in case
-for key in ngram_dictionary:
-  ngram_dictionary[key] = float(ngram_dictionary[key] / counter)
-  if minimum_prob > ngram_dictionary[key]:
-    minimum_prob = ngram_dictionary[key]
-
-# calculate probability of the result
-# one probability per sentence
-
-sys.stderr.write('Calculating testing data...\n')
-prob = []
-with open(args.test_data, 'r') as test_data:
-  lines = [l.strip('\n') for l in test_data.readlines()]
-  for sentence in lines:
-    ans_ngrams = ngrams(sentence.split(),
-      args.ngram_num,
-        pad_left=True,
-        pad_right=True,
-        left_pad_symbol='<s>',
-        right_pad_symbol='</s>'
-    )
-    tmp_prob = 1
-    for g in ans_ngrams:
-      if g in ngram_dictionary:
-        tmp_prob = tmp_prob * ngram_dictionary[g]
-      else:
-        tmp_prob = tmp_prob * minimum_prob
-    prob.append(tmp_prob)
-
-# save result in npy format
-np.save("gram_result", np.array(prob))
+    # counting ngram appearance
+    orders = None
+    if args.index or args.backoff:
+      orders = list(range(1, args.ngram_num+1))
+    counter = count_files(file_names, args.ngram_num, orders, args.workers)
+    vocab, tables = counter.vocab, counter.tables()
+    if args.index:
+      save_index(args.index, vocab, tables, sources)
 
+  # calculate probability of the result
+  # one probability per sentence
 
+  sys.stderr.write('Calculating testing data...\n')
+  with open(args.test_data, 'r') as test_data:
+    sentences = [ l.strip('\n').split() for l in test_data ]
+  prob = score_sentences(sentences, vocab, tables, args.ngram_num,
+                         args.backoff)
 
+  # save result in npy format
+  np.save("gram_result", np.array(prob))
@@ -0,0 +1,62 @@
+'''Word normalization used by parse.py.
+
+Results are memoized per raw token since a book repeats the same few
+thousand tokens over and over. ASCII tokens, nearly all of them, are
+handled with precompiled regexes; other tokens go through the generic
+unicode-aware checks, so the results are the same for every input.
+'''
+import re, string
+from functools import lru_cache
+
+# bound of the memoization caches, larger than the vocabulary of a book
+CACHE_SIZE = 1 << 18
+
+_ascii = re.compile(r'[\x00-\x7f]*\Z')
+_digit = re.compile(r'[0-9]')
+_alpha = re.compile(r'[A-Za-z]')
+_non_alpha = re.compile(r'[^A-Za-z]+')
+_non_printable = re.compile('[^' + re.escape(string.printable) + ']')
+_vowel = re.compile(r'[aeiouy]')
+
+@lru_cache(maxsize=CACHE_SIZE)
+def valid_word(word):
+  '''whether a word may appear in a valid English sentence'''
+  if _non_printable.search(word):
+    return False
+  has_alpha = _alpha.search(word) is not None
+  if has_alpha and _digit.search(word):
+    return False
+  if has_alpha and not _vowel.search(word):
+    return False
+  return True
+
+# Check whether given sentence is a valid English sentence
+def valid(sentence):
+  return all(valid_word(word) for word in sentence.split())
+
+@lru_cache(maxsize=CACHE_SIZE)
+def word_normalize(word):
+  '''0 for numbers, letters only for words mixed with other characters,
+  except short contractions like 's and 're'''
+  if not _ascii.match(word):
+    return _word_normalize(word)
+  if _digit.search(word):
+    return '0'
+  if word.isalpha():
+    return word
+  letters = _non_alpha.sub('', word)
+  if not letters:
+    return word
+  if 1<len(word)<4 and word[0]=='\'' and word[1].isalpha():
+    return word
+  return letters
+
+def _word_normalize(word):
+  if any(c.isdigit() for c in word):
+    return '0'
+  if any(c.isalpha() for c in word):
+    if not all(c.isalpha() for c in word):
+      if len(word)>1 and word[0]=='\'' and word[1].isalpha() and len(word)<4:
+        return word
+      return ''.join(c if c.isalpha() else '' for c in word)
+  return word
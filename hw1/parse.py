@@ -2,88 +2,184 @@
 import argparse
 import re, string
 import os, sys
+from array import array
+import gzip, hashlib, itertools, json, marshal, sqlite3, zlib
+from multiprocessing import Pool
 import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
+from glove_store import GloveStore
+from normalize import valid, word_normalize
 from nltk.tokenize import sent_tokenize
 from nltk.tokenize import word_tokenize
 
-# Generating dependency tree
-def to_nltk_tree(node):
-  if node.n_lefts + node.n_rights > 0:
-    return Tree(node.orth_, [to_nltk_tree(child) for child in node.children])
-  else:
-    return node.orth_
-
-# Check whether given sentence is a valid English sentence
-def valid(sentence):
-  for word in sentence.split():
-    if not all(c in string.printable for c in word):
-      return False
-    has_digit = any(c in string.digits for c in word)
-    has_alpha = any(c in string.ascii_letters for c in word)
-    if has_digit and has_alpha:
-      return False
-    if has_alpha:
-      if not any(c in ['a','e','i','o','u','y'] for c in word):
-        return False
-  return True
-
-def word_normalize(word):
-  if any(c.isdigit() for c in word):
-    return '0'
-  if any(c.isalpha() for c in word):
-    if not all(c.isalpha() for c in word):
-      if len(word)>1 and word[0]=='\'' and word[1].isalpha() and len(word)<4:
-        return word
-      return ''.join(c if c.isalpha() else '' for c in word)
-  return word
-
-def traverse_tree(writer, tree, dep, words_id, useful, choice):
-  if isinstance(tree, str):
-    word = tree
-  else:
-    word = tree._label if isinstance(tree._label, str) \
-                       else unicode_repr(self._label)
-  if len(words_id) <= dep:
-    words_id.append(0)
-  if word == choice:
-    useful = True
-  if word == '*':
-    dep -= 1
-  else:
-    words_id[dep] = 0 if word not in vocab_table else vocab_table[word]
-  leaf = True
-  if not isinstance(tree, str):
-    for child in tree:
-      leaf = False
-      if isinstance(child, Tree):
-        traverse_tree(writer, child, dep+1, words_id, useful, choice)
-      elif isinstance(child, tuple):
-        for cc in child:
-          traverse_tree(writer, cc, dep+1, words_id, useful, choice)
-      elif isinstance(child, str):
-        traverse_tree(writer, child, dep+1, words_id, useful, choice)
+# Trees are stored in preorder as their words and numbers of children,
+# read straight from the spacy tokens without recursion
+def encode_tree(root):
+  words, degrees = [], []
+  stack = [root]
+  while stack:
+    node = stack.pop()
+    children = list(node.children)
+    words.append(node.orth_)
+    degrees.append(len(children))
+    stack.extend(reversed(children))
+  return words, degrees
+
+# Parsed trees don't depend on vocabulary or filtering options, so they are
+# cached in a sqlite database keyed by the sha1 of the normalized sentence.
+# Every process opens its own connection.
+def tree_cache():
+  global cache_conn
+  if cache_conn is None or cache_conn[0] != os.getpid():
+    conn = sqlite3.connect(args.tree_cache, timeout=600)
+    conn.execute('CREATE TABLE IF NOT EXISTS trees '
+                 '(key BLOB PRIMARY KEY, trees BLOB)')
+    cache_conn = (os.getpid(), conn)
+  return cache_conn[1]
+
+# Parse sentences with spacy in batches, sentences already in the cache are
+# not parsed again. For each sentence, the encoded trees of its
+# sub-sentences are yielded in the original order.
+def dependency_trees(sents):
+  sents = iter(sents)
+  while True:
+    batch = list(itertools.islice(sents, args.parse_batch_size))
+    if not batch: return
+    keys = [ hashlib.sha1(sent.encode('utf-8')).digest() for sent in batch ]
+    trees = [None] * len(batch)
+    if args.tree_cache:
+      conn = tree_cache()
+      for i, key in enumerate(keys):
+        row = conn.execute('SELECT trees FROM trees WHERE key=?',
+                           (key,)).fetchone()
+        if row is not None:
+          trees[i] = marshal.loads(zlib.decompress(row[0]))
+    misses = [ i for i, t in enumerate(trees) if t is None ]
+    docs = en_nlp.pipe([ batch[i] for i in misses ],
+                       batch_size=args.parse_batch_size,
+                       n_threads=args.parse_threads)
+    for i, doc in zip(misses, docs):
+      trees[i] = [ encode_tree(sub_sent.root)
+                   for sub_sent in doc.sents ]
+    if args.tree_cache and misses:
+      with conn:
+        conn.executemany('INSERT OR IGNORE INTO trees VALUES (?, ?)',
+                         [ (keys[i], zlib.compress(marshal.dumps(trees[i])))
+                           for i in misses ])
+    for sent_trees in trees:
+      yield sent_trees
+
+# Collect the root-to-leaf paths of the encoded trees of a sentence into one
+# flat buffer of word ids with offsets. The current path is kept in a
+# preallocated array and trees are walked iteratively, so deep trees don't
+# hit the recursion limit. Unless useful is set, only the paths passing
+# through choice are kept.
+def tree_paths(trees, useful, choice):
+  buf, offsets = array('q'), [0]
+  for words, degrees in trees:
+    if degrees[0] == 0: continue
+    path = array('q', [0]) * len(words)
+    # depth, usefulness and number of unvisited children of open nodes
+    stack = []
+    for word, degree in zip(words, degrees):
+      if stack:
+        parent = stack[-1]
+        dep, use = parent[0], parent[1]
+        parent[2] -= 1
+        if parent[2] == 0: stack.pop()
       else:
-        traverse_tree(writer, unicode_repr(child), dep+1, words_id, useful, choice)
-  if leaf and useful:
-    global count_sentences
-    global counter_tree
-    count_sentences += 1
-    counter_tree += 1
-    example = tf.train.Example(
-      features=tf.train.Features(
-        feature={
-          'content': tf.train.Feature(
-          int64_list=tf.train.Int64List(value=words_id[:dep+1])),
-          'len': tf.train.Feature(
-          int64_list=tf.train.Int64List(value=[dep+1]))}))
-    serialized = example.SerializeToString()
-    writer.write(serialized)
-
-# Parse the given content into dependency trees
-def Parse(f, writer, dependency_tree, quote_split, comma_split,
-          min_words, max_words, slice_out, self_parse):
+        dep, use = 0, useful
+      if word == choice:
+        use = True
+      if word == '*':
+        dep -= 1
+      else:
+        path[dep] = vocab_table.get(word, 0)
+      if degree > 0:
+        stack.append([dep+1, use, degree])
+      elif use:
+        buf.extend(path[:dep+1])
+        offsets.append(len(buf))
+  return buf, offsets
+
+class RecordWriter(object):
+
+  '''writes sequences of word ids in a flat buffer as TFRecorder examples'''
+
+  def __init__(self, path):
+    self._writer = tf.python_io.TFRecordWriter(path)
+    # a single example is reused for all sequences
+    self._example = tf.train.Example()
+
+  def write(self, buf, offsets):
+    feature = self._example.features.feature
+    records = []
+    for st, ed in zip(offsets[:-1], offsets[1:]):
+      feature['content'].int64_list.value[:] = buf[st:ed]
+      feature['len'].int64_list.value[:] = [ed-st]
+      records.append(self._example.SerializeToString())
+    for serialized in records:
+      self._writer.write(serialized)
+
+  def close(self):
+    self._writer.close()
+
+class RaggedWriter(object):
+
+  '''writes sequences of word ids into one int32 array plus offsets'''
+
+  def __init__(self, path):
+    self._prefix = re.sub(r'\.tfr$', '', path)
+    self._ids = array('q')
+    self._offsets = array('q', [0])
+    # sequences written together (paths of a tree) form a group
+    self._groups = array('q', [0])
+
+  def write(self, buf, offsets):
+    st = len(self._ids)
+    self._ids.extend(buf)
+    self._offsets.extend(st+offset for offset in offsets[1:])
+    self._groups.append(len(self._offsets)-1)
+
+  def close(self):
+    np.save(self._prefix+'.ids.npy',
+            np.frombuffer(self._ids, dtype=np.int64).astype(np.int32))
+    np.save(self._prefix+'.offsets.npy',
+            np.frombuffer(self._offsets, dtype=np.int64))
+    np.save(self._prefix+'.groups.npy',
+            np.frombuffer(self._groups, dtype=np.int64))
+
+def open_writer(path):
+  return RaggedWriter(path) if args.ragged else RecordWriter(path)
+
+# Concatenate ragged files of books into one, the index of the first
+# sequence of each book is saved in PREFIX.books.npy and the one of each
+# group in PREFIX.groups.npy
+def merge_ragged(prefixes, out_prefix):
+  offsets = [ np.load(prefix+'.offsets.npy') for prefix in prefixes ]
+  books = np.cumsum([0] + [ len(offset)-1 for offset in offsets ])
+  ids = np.lib.format.open_memmap(out_prefix+'.ids.npy', mode='w+',
+                                  dtype=np.int32,
+                                  shape=(int(sum(o[-1] for o in offsets)),))
+  merged_offsets = np.zeros(books[-1]+1, dtype=np.int64)
+  groups = []
+  st = 0
+  for prefix, offset, book in zip(prefixes, offsets, books):
+    ids[st:st+offset[-1]] = np.load(prefix+'.ids.npy', mmap_mode='r')
+    merged_offsets[book:book+len(offset)] = offset + st
+    groups.append(np.load(prefix+'.groups.npy')[:-1] + book)
+    st += offset[-1]
+  groups.append([books[-1]])
+  ids.flush()
+  del ids
+  np.save(out_prefix+'.offsets.npy', merged_offsets)
+  np.save(out_prefix+'.groups.npy', np.concatenate(groups))
+  np.save(out_prefix+'.books.npy', books)
+
+# Split the given content into sentences of normalized words. Only sentences
+# containing at least one word of testing data are kept.
+def Tokenize(f, slice_out, self_parse):
   content = re.sub('\n|\r', ' ', ''.join( i for i in f ))
   if slice_out:
     ret = re.search(r"\bC[hH][aA][pP][tT][eE][rR] (I|One|ONE)\b", content)
@@ -92,58 +188,97 @@ def Parse(f, writer, dependency_tree, quote_split, comma_split,
     ed_idx = len(content) if ret is None else ret.start()
     content = content[st_idx:ed_idx]
 
-  global count_sentences
-  global unk_words
-  global total_words
-
+  sents = []
   if not self_parse:
     for sent in sent_tokenize(content):
       if args.debug:
         sys.stderr.write(sent+'\n')
-      words = word_tokenize(sent.lower())
-      mod_sent = ' '.join( word_normalize(w) for w in words )
-      if not any(word_normalize(word) in corpus_testing and\
-                 word_normalize(word).isalpha() for word in words):
+      words = [ word_normalize(w) for w in word_tokenize(sent.lower()) ]
+      if not any(w in corpus_testing and w.isalpha() for w in words):
         continue
-      if dependency_tree:
-        if len(words) < min_words or len(words) > max_words:
-          continue
-        for sub_sent in en_nlp(mod_sent).sents:
-          tree = to_nltk_tree(sub_sent.root)
-          if tree == None or type(tree) == str: continue
-          words_id = []
-          traverse_tree(writer, tree, 0, words_id, True, None)
-      elif writer is None:
-        for word in words:
-          w = word_normalize(word)
-          if w in corpus:
-            corpus[ w ] += 1
-          else:
-            corpus[ w ] = 1
-      else:
-        if len(words) < min_words or len(words) > max_words: continue
-        count_sentences += 1
-        words_id = []
-        for word in words:
-          w = word_normalize(word)
-          words_id.append(0 if w not in vocab_table else vocab_table[w])
-        unk_words += sum(1 if i == 0 else 0 for i in words_id)
-        total_words += len(words_id)
-        example = tf.train.Example(
-          features=tf.train.Features(
-            feature={
-              'content': tf.train.Feature(
-                int64_list=tf.train.Int64List(value=words_id)),
-              'len': tf.train.Feature(
-                int64_list=tf.train.Int64List(value=[len(words_id)]))}))
-        serialized = example.SerializeToString()
-        writer.write(serialized)
-    return
+      sents.append(words)
   """End of nltk parse"""
+  return sents
+
+# Tokenized sentences are cached as gzipped text, one sentence per line, so
+# that the conversion pass never needs to run nltk again
+def token_file(file_name):
+  return args.token_dir+'/'+file_name[21:-4]+'.tok.gz'
+
+def save_tokens(file_name, sents):
+  with gzip.open(token_file(file_name), 'wt', compresslevel=1,
+                 encoding='utf-8', newline='\n') as f:
+    f.write('\n'.join(' '.join(words) for words in sents))
+
+def load_tokens(file_name):
+  with gzip.open(token_file(file_name), 'rt',
+                 encoding='utf-8', newline='\n') as f:
+    content = f.read()
+  return [ sent.split(' ') for sent in content.split('\n') ] if content else []
+
+# Word counts of each book are cached next to its tokens for the manifest
+def counts_file(file_name):
+  return args.token_dir+'/'+file_name[21:-4]+'.counts'
+
+# The manifest in OUTPUT_DIR records, for each book, the sha1 of its content,
+# the hashes of the options it was tokenized and converted with and its
+# statistics, so that a rerun only redoes the books whose inputs changed
+def manifest_file():
+  return args.output_dir+'/manifest.json'
+
+def load_manifest():
+  if args.force_rebuild: return dict()
+  try:
+    with open(manifest_file(),'r') as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return dict()
+
+def save_manifest(manifest):
+  with open(manifest_file()+'.tmp','w') as f:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+  os.replace(manifest_file()+'.tmp', manifest_file())
+
+def file_hash(file_name):
+  with open(file_name,'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+def options_hash(*values):
+  return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+# Parse the given sentences into word counts, raw strings or dependency trees
+def Parse(sents, writer, dependency_tree, min_words, max_words):
+  global count_sentences
+  global unk_words
+  global total_words
+
+  if dependency_tree:
+    mod_sents = ( ' '.join(words) for words in sents
+                  if len(words) >= min_words and len(words) <= max_words )
+    for trees in dependency_trees(mod_sents):
+      buf, offsets = tree_paths(trees, True, None)
+      writer.write(buf, offsets)
+      count_sentences += len(offsets)-1
+    return
+
+  for words in sents:
+    if writer is None:
+      for w in words:
+        if w in corpus:
+          corpus[ w ] += 1
+        else:
+          corpus[ w ] = 1
+    else:
+      if len(words) < min_words or len(words) > max_words: continue
+      count_sentences += 1
+      words_id = [ 0 if w not in vocab_table else vocab_table[w] for w in words ]
+      unk_words += sum(1 if i == 0 else 0 for i in words_id)
+      total_words += len(words_id)
+      writer.write(words_id, [0, len(words_id)])
 
 def Parse_testing(f, writer, dependency_tree, self_parse):
   number_of_tree = []
-  global counter_tree
+  mod_cands, choices = [], []
   for question in f:
     question = question[:-1]
     ret = question.split(',')
@@ -159,14 +294,8 @@ def Parse_testing(f, writer, dependency_tree, self_parse):
             w = word_normalize(word)
             corpus_testing[ w ] = 1
         elif dependency_tree:
-          counter_tree = 0
-          mod_cand = ' '.join( word_normalize(w) for w in words )
-          for sub_sent in en_nlp(mod_cand).sents:
-            tree = to_nltk_tree(sub_sent.root)
-            if tree == None or type(tree) == str: continue
-            words_id = []
-            traverse_tree(writer, tree, 0, words_id, False, word_normalize(choice))
-          number_of_tree.append(counter_tree)
+          mod_cands.append(' '.join( word_normalize(w) for w in words ))
+          choices.append(word_normalize(choice))
         else:
           if args.debug:
             sys.stderr.write(cand + '\n')
@@ -174,19 +303,77 @@ def Parse_testing(f, writer, dependency_tree, self_parse):
           for word in words:
             w = word_normalize(word)
             words_id.append(0 if w not in vocab_table else vocab_table[w])
-          example = tf.train.Example(
-            features=tf.train.Features(
-              feature={
-                'content': tf.train.Feature(
-                  int64_list=tf.train.Int64List(value=words_id)),
-                'len': tf.train.Feature(
-                  int64_list=tf.train.Int64List(value=[len(words_id)]))}))
-          serialized = example.SerializeToString()
-          writer.write(serialized)
+          writer.write(words_id, [0, len(words_id)])
       """End of nltk parse"""
   if dependency_tree:
+    if mod_cands:
+      for choice, trees in zip(choices, dependency_trees(mod_cands)):
+        buf, offsets = tree_paths(trees, False, choice)
+        writer.write(buf, offsets)
+        number_of_tree.append(len(offsets)-1)
     np.save('number_of_tree.npy',np.array(number_of_tree))
 
+# Counting pass over a single book, its own word counts are returned so that
+# counts from different workers can be merged. Books unchanged since the
+# manifest was written reuse their cached counts and tokens.
+def count_file(file_name):
+  global corpus
+  sha1 = file_hash(file_name)
+  entry = manifest.get(file_name, {})
+  if entry.get('sha1') == sha1 and entry.get('tokenize') == tokenize_hash \
+      and os.path.isfile(token_file(file_name)) \
+      and os.path.isfile(counts_file(file_name)):
+    with open(counts_file(file_name),'rb') as f:
+      return sha1, marshal.load(f)
+  corpus = dict()
+  with open(file_name,'r',encoding="utf-8",errors='ignore') as f:
+    if args.debug:
+      sys.stderr.write('start parsing file ' + file_name + '\n')
+    sents = Tokenize(f, args.slice_out, args.self_parse)
+    save_tokens(file_name, sents)
+    Parse(sents, None, False, args.min_words, args.max_words)
+    if args.debug:
+      sys.stderr.write('finished parsing file ' + file_name + '\n')
+  with open(counts_file(file_name),'wb') as f:
+    marshal.dump(corpus, f)
+  return sha1, corpus
+
+def output_file(file_name):
+  if args.ragged:
+    return args.output_dir+'/'+file_name[21:-4]+'.ids.npy'
+  return args.output_dir+'/'+file_name[21:-4]+'.tfr'
+
+# Converting a single book into its own TFRecorder shard, unless the manifest
+# shows it was already converted from the same tokens and vocabulary
+def convert_file(file_name):
+  global count_sentences
+  global unk_words
+  global total_words
+  entry = manifest.get(file_name, {})
+  if entry.get('convert') == convert_hash \
+      and os.path.isfile(output_file(file_name)):
+    return tuple(entry['stats'])
+  count_sentences, unk_words, total_words = 0, 0, 0
+  if args.debug:
+    sys.stderr.write('start converting file ' + file_name + '\n')
+  if os.path.isfile(token_file(file_name)):
+    sents = load_tokens(file_name)
+  else:
+    with open(file_name,'r',encoding="utf-8",errors='ignore') as f:
+      sents = Tokenize(f, args.slice_out, args.self_parse)
+  writer = open_writer(args.output_dir+'/'+file_name[21:-4]+'.tfr')
+  Parse(sents, writer, args.dependency_tree, args.min_words, args.max_words)
+  writer.close()
+  return count_sentences, unk_words, total_words
+
+# Apply func on every file, whole files are distributed to a process pool
+# when more than one worker is asked for. Results keep the order of file_names.
+def map_files(func, file_names):
+  if args.workers > 1:
+    with Pool(args.workers) as pool:
+      return list(tqdm(pool.imap(func, file_names), total=len(file_names)))
+  return [func(file_name) for file_name in tqdm(file_names)]
+
 if __name__ == '__main__':
   # parsing arguments
   argparser = argparse.ArgumentParser(description='Parsing Given datas '
@@ -206,13 +393,19 @@ if __name__ == '__main__':
   argparser.add_argument('-g', '--glove_file',
         type=str, default='data/glove.6B.50d.txt',
         help='GLOVE_FILE is the file containning glove data.'
-             'Should be in the format of glove.#B.#d.txt'
+             'Should be in the format of glove.#B.#d.txt. It is converted '
+             'into a binary store by glove_store.py the first time.'
              ' (default: %(default)s)')
   argparser.add_argument('-o', '--output_dir',
         type=str, default='Training_Data',
         help='OUTPUT_DIR is the directory where the '
              'output files of training datas will be '
              'stored in. (default: %(default)s)',)
+  argparser.add_argument('-td', '--token_dir',
+        type=str, default='Token_Data',
+        help='TOKEN_DIR is the directory where the tokenized sentences of '
+             'each training data are cached between the counting pass and '
+             'the converting pass. (default: %(default)s)',)
   argparser.add_argument('-og', '--output_glove_dir',
         type=str, default='data/',
         help='OUTPUT_GLOVE_DIR is the directory where the '
@@ -258,6 +451,33 @@ if __name__ == '__main__':
         help='Sentences will also be split between comma.'
              ' (default: it won\'t split between comma).',
         action='store_true')
+  argparser.add_argument('-pb', '--parse_batch_size',
+        type=int, default=1000,
+        help='Number of sentences parsed together by the language parser '
+             'when dependency tree is needed. (default: %(default)s)',)
+  argparser.add_argument('-pt', '--parse_threads',
+        type=int, default=2,
+        help='Number of threads used by the language parser '
+             'when dependency tree is needed. (default: %(default)s)',)
+  argparser.add_argument('-rg', '--ragged',
+        help='Output will be flat int32 arrays of word ids plus offsets '
+             '(PREFIX.ids.npy and PREFIX.offsets.npy) instead of TFRecorder '
+             'files. Training datas are also merged into OUTPUT_DIR/train.*',
+        action='store_true')
+  argparser.add_argument('-tc', '--tree_cache',
+        type=str, default='tree_cache.db',
+        help='TREE_CACHE is the database caching parsed dependency trees '
+             'between runs. It should be removed after the language parser '
+             'is changed. Empty string disables the cache. '
+             '(default: %(default)s)',)
+  argparser.add_argument('-w', '--workers',
+        type=int, default=1,
+        help='Number of processes used to parse and convert training datas. '
+             'Each process handles whole files. (default: %(default)s)',)
+  argparser.add_argument('-fr', '--force_rebuild',
+        help='Ignore OUTPUT_DIR/manifest.json and parse every book again'
+             ' (default: only books whose inputs changed are parsed).',
+        action='store_true')
   argparser.add_argument('-de', '--debug',
         help='Show more debug infos',
         action='store_true')
@@ -265,59 +485,67 @@ if __name__ == '__main__':
 
   if args.dependency_tree:
     import spacy
-    from nltk import Tree
     sys.stderr.write('loading lauguage parser...\n')
     # English language parser
     en_nlp = spacy.load('en')
 
   corpus = dict()
   corpus_testing = dict()
+  cache_conn = None
   global count_sentences
   global counter
-  global counter_tree
   count_sentences = 0
   counter = 0
-  counter_tree = 0
 
   if not args.skip:
     sys.stderr.write('start parsing datas...\n')
+    if not os.path.exists(args.token_dir):
+      os.makedirs(args.token_dir)
     with open(args.testing_data,'r',encoding="utf-8",errors='ignore') as f:
       Parse_testing(f, None, args.dependency_tree, args.self_parse)
+    if not os.path.exists(args.output_dir):
+      os.makedirs(args.output_dir)
     with open(args.file_list,'r') as file_list:
-      for file_name in tqdm(file_list):
-        with open(file_name[:-1],'r',encoding="utf-8",errors='ignore') as f:
-          if args.debug:
-            sys.stderr.write('start parsing file ' + file_name[:-1] + '\n')
-          Parse(f, None, False, args.quote_split, args.comma_split,
-                args.min_words, args.max_words, args.slice_out, args.self_parse)
-          if args.debug:
-            sys.stderr.write('finished parsing file ' + file_name[:-1] + '\n')
+      file_names = file_list.read().splitlines()
+    # tokens depend on testing data, only sentences using its words are kept
+    tokenize_hash = options_hash(args.slice_out, args.self_parse,
+                                 file_hash(args.testing_data))
+    manifest = load_manifest()
+    counted = map_files(count_file, file_names)
+    merged_corpus = dict()
+    old_manifest, manifest = manifest, dict()
+    for file_name, (sha1, file_corpus) in zip(file_names, counted):
+      for w, cnt in file_corpus.items():
+        merged_corpus[ w ] = merged_corpus.get(w, 0) + cnt
+      # entries of changed books lose their converting state
+      entry = old_manifest.get(file_name, {})
+      if entry.get('sha1') != sha1 or entry.get('tokenize') != tokenize_hash:
+        entry = {'sha1': sha1, 'tokenize': tokenize_hash}
+      manifest[file_name] = entry
+    save_manifest(manifest)
+    corpus = merged_corpus
 
   sys.stderr.write('start embedding words...\n')
   vocab_name = re.sub('glove','vocab',args.glove_file)
   if not args.skip:
-    with open(args.glove_file,'r') as glove:
-      ret = re.search(r"/", vocab_name)
-      if ret is None: vocab_name = args.output_glove_dir + vocab_name
-      else: vocab_name = args.output_glove_dir + vocab_name[ret.start():]
-      wordvec_name = re.sub('txt','npy',re.sub('glove','wordvec',args.glove_file))
-      if ret is None: wordvec_name = args.output_glove_dir + wordvec_name
-      else: wordvec_name = args.output_glove_dir + wordvec_name[ret.start():]
-      with open(vocab_name,'w') as word_list:
-        dimension = int(args.glove_file.split('.')[2][:-1])
-        word_list.write("<unk>\n")
-        res = [[]]
-        for word in tqdm(glove):
-          ret = word.split()
-          if (ret[0] in corpus and corpus[ret[0]] >= args.count) or \
-              ret[0] in corpus_testing:
-            word_list.write(ret[0]+'\n')
-            res.append(list(map(float,ret[1:])))
-        for i in res:
-          while len(i) < dimension:
-            i.append(float(0))
-        np.save(wordvec_name,np.array(res))
-        sys.stderr.write('number of useful words : %d\n' % (len(res)))
+    glove = GloveStore(args.glove_file)
+    ret = re.search(r"/", vocab_name)
+    if ret is None: vocab_name = args.output_glove_dir + vocab_name
+    else: vocab_name = args.output_glove_dir + vocab_name[ret.start():]
+    wordvec_name = re.sub('txt','npy',re.sub('glove','wordvec',args.glove_file))
+    if ret is None: wordvec_name = args.output_glove_dir + wordvec_name
+    else: wordvec_name = args.output_glove_dir + wordvec_name[ret.start():]
+    useful = [ w for w in glove.words
+               if (w in corpus and corpus[w] >= args.count) or \
+                   w in corpus_testing ]
+    with open(vocab_name,'w') as word_list:
+      word_list.write("<unk>\n")
+      for w in useful:
+        word_list.write(w+'\n')
+    res = np.concatenate([np.zeros([1, glove.dimension], dtype=np.float32),
+                          glove.rows(useful)])
+    np.save(wordvec_name,res)
+    sys.stderr.write('number of useful words : %d\n' % (len(res)))
 
   vocab_table = dict()
   vocab_table_idx = 0
@@ -329,17 +557,22 @@ if __name__ == '__main__':
   if not args.skip:
     sys.stderr.write('start transforming training datas'
                      ' into the format of TFRecoder files...\n')
-    global unk_words
-    global total_words
-    unk_words, total_words = 0, 0
     with open(args.file_list,'r') as file_list:
-      for file_name in tqdm(file_list):
-        with open(file_name[:-1],'r',encoding="utf-8",errors='ignore') as f:
-          if args.debug:
-            sys.stderr.write('start converting file ' + file_name[:-1] + '\n')
-          writer = tf.python_io.TFRecordWriter(args.output_dir+'/'+file_name[21:-5]+'.tfr')
-          Parse(f, writer, args.dependency_tree, args.quote_split, args.comma_split,
-                args.min_words, args.max_words, args.slice_out, args.self_parse)
+      file_names = file_list.read().splitlines()
+    with open(vocab_name,'rb') as vocab:
+      vocab_hash = hashlib.sha1(vocab.read()).hexdigest()
+    convert_hash = options_hash(tokenize_hash, args.dependency_tree,
+                                args.min_words, args.max_words, args.ragged,
+                                vocab_hash)
+    stats = map_files(convert_file, file_names)
+    for file_name, file_stats in zip(file_names, stats):
+      manifest[file_name].update(convert=convert_hash, vocab=vocab_hash,
+                                 stats=list(file_stats))
+    save_manifest(manifest)
+    count_sentences, unk_words, total_words = map(sum, zip(*stats))
+    if args.ragged:
+      merge_ragged([ args.output_dir+'/'+file_name[21:-4]
+                     for file_name in file_names ], args.output_dir+'/train')
     #sys.stderr.write('unk_words: %d, total_words: %d, perc: %f%%\n' %
     #                 (unk_words, total_words, unk_words * 100 / total_words))
     sys.stderr.write('Number of sentences: %d\n' % count_sentences)
@@ -347,7 +580,8 @@ if __name__ == '__main__':
   sys.stderr.write('start transforming testing data '
                    'into the format of TFRecoder file...\n')
   with open(args.testing_data,'r',encoding="utf-8",errors='ignore') as f:
-    writer = tf.python_io.TFRecordWriter(args.output_file)
+    writer = open_writer(args.output_file)
     Parse_testing(f, writer, args.dependency_tree, args.self_parse)
+    writer.close()
 
   sys.stderr.write('cooling down...\n')
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+import deprnn
+
+def test_two_level_softmax_sums_to_one():
+  #10 words in 7 clusters of 2 words would leave 2 empty clusters
+  vocab_size, hidden_size, n = 10, 4, 3
+  with tf.Graph().as_default():
+    with tf.variable_scope('softmax',
+                           initializer=tf.random_normal_initializer()):
+      hsm = deprnn.TwoLevelSoftmax(vocab_size, hidden_size, 7)
+    output = tf.constant(np.random.randn(n, hidden_size), dtype=tf.float32)
+    targets = tf.tile(tf.range(vocab_size)[:, None], [1, n])
+    log_prob = hsm.log_prob(output, targets)
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      prob = np.exp(sess.run(log_prob))
+  np.testing.assert_allclose(prob.sum(0), np.ones(n), rtol=1e-5)
+
+@pytest.mark.parametrize('use_bi', [False, True])
+def test_shared_prefix_scores(monkeypatch, use_bi):
+  #candidates whose blanks have different numbers of words
+  seqs = [[1, 2, 3, 4, 5, 6, 7], [1, 2, 3, 8, 9, 5, 6, 7],
+          [1, 2, 3, 10, 5, 6, 7], [1, 2, 3, 11, 12, 13, 5, 6, 7],
+          [1, 2, 3, 14, 5, 6]]
+  ids = np.concatenate(seqs).astype(np.int64)
+  offsets = np.cumsum([0]+[ len(seq) for seq in seqs ])
+  monkeypatch.setattr(deprnn, 'get_ragged_data', lambda para:
+                      deprnn.RaggedData(ids, offsets, shuffle=False))
+  def testing_para(argv):
+    para = deprnn.parser.parse_args(['-rg', '-sl', '0', '-hs', '8', '-ln', '2']
+                                    +(['-ub'] if use_bi else [])+argv)
+    vars(para).update(vocab_size=20, embed_dim=6, mode=2, batch_size=5)
+    return para
+  para, shared_para = testing_para([]), testing_para(['-sp'])
+
+  with tf.Graph().as_default():
+    #the shared-prefix graph creates the variables, like with -io -sp
+    initializer = tf.random_uniform_initializer(-0.5, 0.5)
+    with tf.variable_scope('model', initializer=initializer):
+      shared = deprnn.DepRNN(shared_para)
+    with tf.variable_scope('model', reuse=True):
+      flat = deprnn.DepRNN(para)
+      W_E = deprnn.embedding(para)
+    with tf.Session() as sess:
+      sess.run([tf.global_variables_initializer(),
+                tf.local_variables_initializer()])
+      sess.run(W_E.assign(np.random.randn(20, 6)))
+      shared_scores = sess.run(shared.scores, feed_dict=shared.feed_dict())
+      flat_scores = sess.run(flat.scores, feed_dict=flat.feed_dict())
+  np.testing.assert_allclose(shared_scores, flat_scores, rtol=1e-4, atol=1e-4)
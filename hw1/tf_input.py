@@ -0,0 +1,111 @@
+'''Batched input from TFRecorder files shared by the models of hw1 and hw2.
+
+batch() replaces string_input_producer + TFRecordReader + tf.train.batch.
+With tf.data, files are read by parallel interleaved readers, records are
+parsed by num_parallel_calls threads, optionally cached in memory, shuffled,
+padded into batches and prefetched. Versions of tensorflow without tf.data
+fall back to queue runners reading and parsing in several threads. Either
+way the batches are the same dense tensors, padded with 0 to the longest
+example of the batch.
+
+tf.data appeared in TF 1.4, parallel_interleave in 1.5 and
+bucket_by_sequence_length in 1.8, both in tf.contrib.data; the versions in
+between use interleave and group_by_window instead.
+'''
+import tensorflow as tf
+
+def _contrib_data(name):
+  '''transformation name of tf.contrib.data, None if this version lacks it'''
+  return getattr(getattr(tf.contrib, 'data', None), name, None)
+
+def _has_dataset(boundaries):
+  if not hasattr(tf, 'data'):
+    return False
+  return not boundaries or _contrib_data('bucket_by_sequence_length')\
+      or _contrib_data('group_by_window')
+
+def batch(filenames, parse, batch_size, shuffle=True, cache=False,
+          boundaries=None, length=None, num_parallel_reads=4,
+          num_parallel_calls=4, shuffle_buffer=1024, prefetch=2,
+          group_size=None):
+  '''tensors of the next batch of records of filenames, repeated forever.
+  parse maps a serialized tf.train.Example to a tuple of dense tensors.
+  Without shuffle, records keep the order of filenames. With boundaries,
+  examples are grouped into buckets by length, a function of the parsed
+  tuple, like tf.contrib.training.bucket_by_sequence_length.
+  With group_size, parse maps instead a vector of up to group_size
+  consecutive serialized records of the same file, like the captions of a
+  video, which needs tf.data.'''
+  if _has_dataset(boundaries):
+    tensors = _dataset_batch(filenames, parse, batch_size, shuffle, cache,
+                             boundaries, length, num_parallel_reads,
+                             num_parallel_calls, shuffle_buffer, prefetch,
+                             group_size)
+  elif group_size:
+    raise ValueError('grouping records needs tf.data')
+  else:
+    tensors = _queue_batch(filenames, parse, batch_size, shuffle,
+                           boundaries, length, num_parallel_reads, prefetch)
+  #batches are always full since records are repeated
+  for tensor in tensors:
+    tensor.set_shape([batch_size]+tensor.get_shape().as_list()[1:])
+  return tensors
+
+def _dataset_batch(filenames, parse, batch_size, shuffle, cache,
+                   boundaries, length, num_parallel_reads,
+                   num_parallel_calls, shuffle_buffer, prefetch, group_size):
+  def read(filename):
+    records = tf.data.TFRecordDataset(filename)
+    return records.batch(group_size) if group_size else records
+  files = tf.data.Dataset.from_tensor_slices(filenames)
+  if shuffle:
+    files = files.shuffle(len(filenames))
+  #one reader keeps the order of records
+  cycle_length = num_parallel_reads if shuffle else 1
+  if _contrib_data('parallel_interleave'):
+    dataset = files.apply(_contrib_data('parallel_interleave')(
+        read, sloppy=shuffle, cycle_length=cycle_length))
+  else:
+    dataset = files.interleave(read, cycle_length=cycle_length,
+                               block_length=1)
+  dataset = dataset.map(parse, num_parallel_calls=num_parallel_calls)
+  if cache:
+    dataset = dataset.cache()
+  if shuffle:
+    dataset = dataset.shuffle(shuffle_buffer)
+  dataset = dataset.repeat()
+  if boundaries and _contrib_data('bucket_by_sequence_length'):
+    dataset = dataset.apply(_contrib_data('bucket_by_sequence_length')(
+        lambda *example: tf.to_int32(length(example)), boundaries,
+        [batch_size]*(len(boundaries)+1),
+        padded_shapes=dataset.output_shapes))
+  elif boundaries:
+    #the bucket of an example is the number of boundaries not above its length
+    def bucket(*example):
+      return tf.reduce_sum(tf.to_int64(
+          tf.greater_equal(tf.to_int32(length(example)), boundaries)))
+    padded_shapes = dataset.output_shapes
+    dataset = dataset.apply(_contrib_data('group_by_window')(
+        bucket, lambda _, window: window.padded_batch(batch_size,
+                                                      padded_shapes),
+        batch_size))
+  else:
+    dataset = dataset.padded_batch(batch_size, dataset.output_shapes)
+  dataset = dataset.prefetch(prefetch)
+  return dataset.make_one_shot_iterator().get_next()
+
+def _queue_batch(filenames, parse, batch_size, shuffle, boundaries, length,
+                 num_parallel_reads, prefetch):
+  f_queue = tf.train.string_input_producer(filenames, shuffle=shuffle)
+  _, serialized_example = tf.TFRecordReader().read(f_queue)
+  example = list(parse(serialized_example))
+  #several threads read and parse records, one keeps the order of records
+  num_threads = num_parallel_reads if shuffle else 1
+  if boundaries:
+    _, tensors = tf.contrib.training.bucket_by_sequence_length(
+        tf.to_int32(length(example)), example, batch_size, boundaries,
+        num_threads=num_threads, capacity=prefetch*batch_size,
+        dynamic_pad=True)
+    return tensors
+  return tf.train.batch(example, batch_size, num_threads=num_threads,
+                        capacity=prefetch*batch_size, dynamic_pad=True)
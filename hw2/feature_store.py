@@ -0,0 +1,169 @@
+'''Video features of hw2 stored once per video.
+
+With `./parse.py -fs`, the features of all videos of an output directory
+are written into one videos.npy, row i holding the frames of video i, and
+the TFRecorder records keep only that index instead of a copy of the
+80x4096 floats for every caption. Readers find the store next to the
+TFRecorder files, map it into memory and read the frames of a video from
+it, so nothing is duplicated on disk nor decoded more than once.
+
+The store may also keep only every step-th frame, frames projected to
+fewer dimensions (PCA or random projection), and int8 frames with one
+scale per frame in videos.scale.npy. videos.json records the layout, so
+readers adapt to it by themselves.
+'''
+import os, json
+import numpy as np
+import tensorflow as tf
+
+STORE_NAME = 'videos.npy'
+SCALE_NAME = 'videos.scale.npy'
+LAYOUT_NAME = 'videos.json'
+PROJECTION_NAME = 'projection.npz'
+
+class Store(object):
+  '''frames of the videos of a directory, every step-th frame of the
+  original videos, with the scales of the frames if they are quantized'''
+
+  def __init__(self, frames, scales=None, step=1):
+    self.frames = frames
+    self.scales = scales
+    self.step = step
+
+  @property
+  def dim(self): return self.frames.shape[2]
+
+  def flush(self):
+    self.frames.flush()
+    if self.scales is not None:
+      self.scales.flush()
+
+def store_file(directory, name=STORE_NAME):
+  return os.path.join(directory, name)
+
+def create(directory, num_videos, frame_shape, dtype, step=1, quantize=False):
+  '''writable memory-mapped store of num_videos videos in directory,
+  frame_shape being the shape of the videos to be written'''
+  remove(directory)
+  shape = (num_videos, len(range(0, frame_shape[0], step)), frame_shape[1])
+  frames = np.lib.format.open_memmap(store_file(directory), mode='w+',
+                                     dtype='int8' if quantize else dtype,
+                                     shape=shape)
+  scales = None
+  if quantize:
+    scales = np.lib.format.open_memmap(store_file(directory, SCALE_NAME),
+                                       mode='w+', dtype=np.float32,
+                                       shape=shape[:2])
+  with open(store_file(directory, LAYOUT_NAME), 'w') as f:
+    json.dump({'step': step, 'quantized': quantize}, f)
+  return Store(frames, scales, step)
+
+def remove(directory):
+  '''drop the store of directory, its records hold the features again'''
+  for name in [STORE_NAME, SCALE_NAME, LAYOUT_NAME]:
+    if os.path.exists(store_file(directory, name)):
+      os.remove(store_file(directory, name))
+
+def write(store, index, video, projection=None):
+  '''store video index, projected by projection (mean, matrix) if any'''
+  video = video[::store.step]
+  if projection is not None:
+    video = project(video, projection)
+  if store.scales is None:
+    store.frames[index] = video
+  else:
+    store.frames[index], store.scales[index] = quantize(video)
+
+def quantize(video):
+  '''int8 frames of video and the scale of each frame'''
+  scales = np.abs(video).max(axis=1) / 127.
+  scales[scales == 0] = 1.
+  frames = np.round(video / scales[:, None]).astype(np.int8)
+  return frames, scales.astype(np.float32)
+
+def random_projection(dim_in, dim, seed=0):
+  '''zero mean and gaussian matrix projecting dim_in to dim dimensions'''
+  rng = np.random.RandomState(seed)
+  matrix = rng.randn(dim_in, dim) / np.sqrt(dim)
+  return np.zeros(dim_in, np.float32), matrix.astype(np.float32)
+
+def pca(videos, dim):
+  '''mean and the dim principal axes of the frames of videos'''
+  count, total, outer = 0, 0., 0.
+  for video in videos:
+    video = video.astype(np.float64)
+    count += len(video)
+    total = total + video.sum(axis=0)
+    outer = outer + video.T.dot(video)
+  mean = total / count
+  _, axes = np.linalg.eigh(outer / count - np.outer(mean, mean))
+  return mean.astype(np.float32), axes[:, ::-1][:, :dim].astype(np.float32)
+
+def project(video, projection):
+  mean, matrix = projection
+  return (video - mean).dot(matrix)
+
+def save_projection(directory, projection):
+  mean, matrix = projection
+  np.savez(store_file(directory, PROJECTION_NAME), mean=mean, matrix=matrix)
+
+def load(filenames):
+  '''memory-mapped store next to the TFRecorder files filenames, None if
+  their records hold the features themselves'''
+  directory = os.path.dirname(filenames[0])
+  if not os.path.exists(store_file(directory)):
+    return None
+  layout = {'step': 1, 'quantized': False}
+  if os.path.exists(store_file(directory, LAYOUT_NAME)):
+    with open(store_file(directory, LAYOUT_NAME)) as f:
+      layout.update(json.load(f))
+  frames = np.load(store_file(directory), mmap_mode='r')
+  scales = None
+  if layout['quantized']:
+    scales = np.load(store_file(directory, SCALE_NAME), mmap_mode='r')
+  return Store(frames, scales, layout['step'])
+
+def parse_index(serialized_example, features):
+  '''index of the video of an example with its other features'''
+  features = dict(features, index=tf.FixedLenFeature([], tf.int64))
+  return tf.parse_single_example(serialized_example, features=features)
+
+def video(store, index, step=1):
+  '''float32 frames of video index of store, every step-th frame of the
+  original video only'''
+  if step % store.step:
+    raise ValueError('video step %d is not a multiple of the stored step %d'
+                     % (step, store.step))
+  step //= store.step
+  if store.scales is None:
+    def read(i):
+      return np.asarray(store.frames[i, ::step], dtype=np.float32)
+    frames = tf.py_func(read, [index], tf.float32, stateful=False)
+  else:
+    def read(i):
+      return (np.asarray(store.frames[i, ::step]),
+              np.asarray(store.scales[i, ::step]))
+    frames, scales = tf.py_func(read, [index], [tf.int8, tf.float32],
+                                stateful=False)
+    frames = tf.to_float(frames) * tf.expand_dims(scales, 1)
+  frames.set_shape([len(range(0, store.frames.shape[1], step)), store.dim])
+  return frames
+
+def parse_video(serialized_example, store, dim, step=1, num_frames=None,
+                features=None):
+  '''every step-th frame of the video of an example with its other features,
+  read from store if any, else from the floats of the record, num_frames x
+  dim of them or any number of dim-sized frames if num_frames is None'''
+  features = dict(features or {})
+  if store is not None:
+    features = parse_index(serialized_example, features)
+    return video(store, features['index'], step), features
+  if num_frames is None:
+    features['video'] = tf.VarLenFeature(tf.float32)
+  else:
+    features['video'] = tf.FixedLenFeature([num_frames*dim], tf.float32)
+  features = tf.parse_single_example(serialized_example, features=features)
+  frames = features['video']
+  if num_frames is None:
+    frames = tf.sparse_tensor_to_dense(frames)
+  return tf.reshape(frames, [-1, dim])[::step], features
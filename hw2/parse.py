@@ -4,6 +4,7 @@ import tensorflow as tf
 import numpy as np
 from tqdm import tqdm
 from gensim.models import word2vec
+import feature_store
 
 def normalize(sent):
   s = sent.lower()
@@ -11,6 +12,37 @@ def normalize(sent):
     s = re.sub('['+deli+']', ' '+deli, s)
   return '<bos> ' + ' '.join(s.split()) + ' <eos>'
 
+def video_feature(video, store, index, projection=None):
+  '''feature of a record pointing to video index of store if any, else
+  holding the features of the video'''
+  if store is None:
+    return {'video': tf.train.Feature(
+        float_list=tf.train.FloatList(value=video.reshape(-1)))}
+  feature_store.write(store, index, video.reshape((80, 4096)), projection)
+  return {'index': tf.train.Feature(
+      int64_list=tf.train.Int64List(value=[index]))}
+
+def open_store(directory, num_videos, projection=None):
+  if not args.feature_store:
+    feature_store.remove(directory)
+    return None
+  dim = args.projection_dim if projection is not None else 4096
+  return feature_store.create(directory, num_videos, (80, dim),
+                              args.feature_type, args.store_step,
+                              args.quantize)
+
+def fit_projection(labels):
+  '''projection of the frames to args.projection_dim dimensions if any'''
+  if not args.projection_dim:
+    return None
+  if args.projection_type == 'random':
+    return feature_store.random_projection(4096, args.projection_dim)
+  sys.stderr.write('fitting PCA on training frames...\n')
+  videos = ( np.load(args.input_dir+'/'+label['id']+'.npy')
+            .reshape((80, 4096))[::args.store_step]
+            for label in tqdm(labels) )
+  return feature_store.pca(videos, args.projection_dim)
+
 if __name__ == '__main__':
   argparser = argparse.ArgumentParser(description='Parsing given datas '
       'into the format of TFRecorder file.')
@@ -47,7 +79,29 @@ if __name__ == '__main__':
         help='OUTPUT_VECTOR_FILE is the file storing embedding word '
              'vector in the order of embedding in the numpy array format.'
              '(default: %(default)s)',)
+  argparser.add_argument('-fs', '--feature_store',
+      help='store the features of each video once in videos.npy of the '
+      'output directory, records only keep the index of their video',
+      action='store_true')
+  argparser.add_argument('-ft', '--feature_type', type=str,
+      default='float16', choices=['float16', 'float32'],
+      help='type of the features in the store (default: %(default)s)')
+  argparser.add_argument('-st', '--store_step', type=int, default=1,
+      help='store only every STORE_STEP-th frame, readers need a video '
+      'step multiple of it (default: %(default)s)')
+  argparser.add_argument('-pd', '--projection_dim', type=int, default=0,
+      help='project stored frames to PROJECTION_DIM dimensions fitted on '
+      'training data, 0 for no projection (default: %(default)s)')
+  argparser.add_argument('-pt', '--projection_type', type=str,
+      default='pca', choices=['pca', 'random'],
+      help='projection of stored frames (default: %(default)s)')
+  argparser.add_argument('-q', '--quantize',
+      help='store frames as int8 with a scale for each frame',
+      action='store_true')
   args = argparser.parse_args()
+  if not args.feature_store and (args.store_step > 1 or args.projection_dim
+                                 or args.quantize):
+    argparser.error('-st, -pd and -q only apply to the store of -fs')
 
   with open(args.training_label, 'r') as label_json:
     labels = json.load(label_json)
@@ -74,10 +128,14 @@ if __name__ == '__main__':
     os.makedirs(args.output_dir)
   with open(args.training_label, 'r') as label_json:
     labels = json.load(label_json)
+    projection = fit_projection(labels) if args.feature_store else None
+    if projection is not None:
+      feature_store.save_projection(args.output_dir, projection)
+    store = open_store(args.output_dir, len(labels), projection)
     for i, label in tqdm(enumerate(labels)):
       out_name = args.output_dir+'/'+label['id']+'.tfr'
       video = np.load(args.input_dir+'/'+label['id']+'.npy')
-      video = video.reshape((-1, 1))
+      feature = video_feature(video, store, i, projection)
       writer = tf.python_io.TFRecordWriter(out_name)
       if args.short:
         words_len = []
@@ -91,11 +149,8 @@ if __name__ == '__main__':
             word_ids = [ dct[word] for word in normalize(sent).split() ]
             example = tf.train.Example(
               features=tf.train.Features(
-                feature={
-                  'video': tf.train.Feature(
-                    float_list=tf.train.FloatList(value=video)),
-                  'caption': tf.train.Feature(
-                    int64_list=tf.train.Int64List(value=word_ids))}))
+                feature=dict(feature, caption=tf.train.Feature(
+                  int64_list=tf.train.Int64List(value=word_ids)))))
             serialized = example.SerializeToString()
             writer.write(serialized)
             break
@@ -104,29 +159,31 @@ if __name__ == '__main__':
           word_ids = [ dct[word] for word in normalize(sent).split() ]
           example = tf.train.Example(
             features=tf.train.Features(
-              feature={
-                'video': tf.train.Feature(
-                  float_list=tf.train.FloatList(value=video)),
-                'caption': tf.train.Feature(
-                  int64_list=tf.train.Int64List(value=word_ids))}))
+              feature=dict(feature, caption=tf.train.Feature(
+                int64_list=tf.train.Int64List(value=word_ids)))))
           serialized = example.SerializeToString()
           writer.write(serialized)
       writer.close()
+    if store is not None:
+      store.flush()
 
   if not os.path.exists(args.testing_output_dir):
     os.makedirs(args.testing_output_dir)
   sys.stderr.write('start converting testing data into TFR format...\n')
   with open(args.testing_id) as testing_id:
-    for file_name in tqdm(testing_id.read().splitlines()):
+    file_names = testing_id.read().splitlines()
+    store = open_store(args.testing_output_dir, len(file_names), projection)
+    for i, file_name in enumerate(tqdm(file_names)):
       video_array = np.load(args.testing_input_dir+'/'+file_name+'.npy')
-      video_array = np.reshape(video_array, 80*4096)
+      video_array = np.reshape(video_array, (80, 4096))
       out_file_name = args.testing_output_dir+'/'+file_name+'.tfr'
       writer = tf.python_io.TFRecordWriter(out_file_name)
       example = tf.train.Example(
           features=tf.train.Features(
-            feature={
-              'video': tf.train.Feature(
-                float_list=tf.train.FloatList(value=video_array))}))
+            feature=video_feature(video_array, store, i,
+                                       projection)))
       serialized = example.SerializeToString()
       writer.write(serialized)
       writer.close()
+    if store is not None:
+      store.flush()
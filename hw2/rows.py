@@ -0,0 +1,20 @@
+'''Row operations on nested structures of tensors, like the encoder outputs
+and LSTM states of the hw2 models.'''
+import tensorflow as tf
+from tensorflow.python.util import nest
+
+def repeat(tensors, num_copies):
+  '''repeat each row of every tensor of the structure tensors num_copies
+  times, like the video of several captions or beams'''
+  def tile(tensor):
+    shape = tf.shape(tensor)
+    tiled = tf.tile(tf.expand_dims(tensor, 1),
+                    [1, num_copies]+[1]*(tensor.get_shape().ndims-1))
+    return tf.reshape(tiled, tf.concat([[-1], shape[1:]], 0))
+  return nest.pack_sequence_as(tensors,
+                               [tile(t) for t in nest.flatten(tensors)])
+
+def gather(tensors, indices):
+  '''rows indices of every tensor of the structure tensors'''
+  return nest.pack_sequence_as(tensors, [tf.gather(t, indices)
+                                         for t in nest.flatten(tensors)])
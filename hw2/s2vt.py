@@ -9,6 +9,9 @@ import json
 import tensorflow.contrib.seq2seq as seq2seq
 from tensorflow.contrib.rnn import LSTMCell, LSTMStateTuple, GRUCell
 from tensorflow.contrib.seq2seq import sequence_loss as sequence_loss
+import tf_input
+import feature_store
+import rows
 
 default_rnn_cell_type         = 2    # 0: BsicRNN, 1: BasicLSTM, 2: FullLSTM, 3: GRU
 default_video_dimension       = 4096 # dimension of each frame
@@ -24,8 +27,9 @@ default_dropout_keep_prob     = 0.7    # for dropout layer
 default_init_scale            = 0.01 # for tensorflow initializer
 default_max_epoch             = 10000
 default_info_epoch            = 10
-default_testing_video_num     = 50     # number of testing videos
+default_test_batch_size       = 256    # testing videos decoded at once
 default_video_step            = 4
+default_captions_per_video    = 0    # 0: a video for each caption
 default_learning_rate         = 0.001
 default_learning_rate_decay_factor = 1
 
@@ -51,6 +55,11 @@ default_validating_mode = 1
 default_testing_mode    = 2
 
 
+def testing_files():
+  file_list_path = 'MLDS_hw2_data/testing_data/Testing_Data_TFR/testing_list.txt'
+  filenames = open(file_list_path).read().splitlines()
+  return ['MLDS_hw2_data/testing_data/Testing_Data_TFR/'+filename for filename in filenames]
+
 class S2VT(object):
 
   def __init__(self, para):
@@ -85,10 +94,31 @@ class S2VT(object):
         [rnn_cell() for _ in range(para.layer_number)])
 
     # get data in batches
+    self._store = feature_store.load(self.get_files())
+    if self._store is not None:
+      # frames of the store may be projected to fewer dimensions
+      para.video_dimension = self._store.dim
     if self.is_train():
-      video, caption, video_len, caption_len = self.get_single_example(para)
-      videos, captions, video_lens, caption_lens = tf.train.batch([video, caption, video_len, caption_len],
-        batch_size=para.batch_size, dynamic_pad=True)
+      if para.captions_per_video:
+        # a row of videos for each video, a row of captions for each caption
+        videos, target_captions, video_lens, caption_lens = tf_input.batch(self.get_files(),
+          lambda serialized: self.parse_group(para, serialized),
+          para.batch_size//para.captions_per_video, cache=para.cache_data,
+          group_size=para.captions_per_video)
+        target_captions = tf.reshape(target_captions, [para.batch_size, -1])
+        caption_lens = tf.reshape(caption_lens, [-1])
+      elif para.tf_data:
+        def parse(serialized_example):
+          video, caption, video_len, caption_len = self.parse_example(para, serialized_example)
+          return video, tf.sparse_tensor_to_dense(caption), video_len, caption_len
+        videos, target_captions, video_lens, caption_lens = tf_input.batch(self.get_files(),
+          parse, para.batch_size, cache=para.cache_data)
+      else:
+        video, caption, video_len, caption_len = self.get_single_example(para)
+        videos, captions, video_lens, caption_lens = tf.train.batch([video, caption, video_len, caption_len],
+          batch_size=para.batch_size, dynamic_pad=True)
+        # sparse tensor cannot be sliced
+        target_captions = tf.sparse_tensor_to_dense(captions)
       
       # construct caption mask for loss computing
       caption_lens = tf.to_int32(caption_lens)
@@ -96,14 +126,17 @@ class S2VT(object):
       max_len = tf.reduce_max(caption_lens)
       caption_mask = tf.sequence_mask(caption_lens_reshape-1, max_len-1, dtype=tf.float32)
       
-      # sparse tensor cannot be sliced
-      target_captions = tf.sparse_tensor_to_dense(captions)
       target_captions_input  = target_captions[:,  :-1] # start from <BOS>
       target_captions_output = target_captions[:, 1:  ] # end by <EOS>
     else:
-      video, video_len = self.get_single_example(para)
-      videos, video_lens = tf.train.batch([video, video_len],
-        batch_size=para.batch_size, dynamic_pad=True)
+      if para.tf_data:
+        videos, video_lens = tf_input.batch(self.get_files(),
+          lambda serialized_example: self.parse_example(para, serialized_example),
+          para.batch_size, shuffle=False, cache=para.cache_data)
+      else:
+        video, video_len = self.get_single_example(para)
+        videos, video_lens = tf.train.batch([video, video_len],
+          batch_size=para.batch_size, dynamic_pad=True)
       max_len = para.max_caption_length
 
     # video and word embeddings as well as word decoding
@@ -120,10 +153,13 @@ class S2VT(object):
         [para.hidden_units, para.vocab_size])
 
     # embed videos
+    num_videos = para.batch_size
+    if self.is_train() and para.captions_per_video:
+      num_videos //= para.captions_per_video
     video_flat = tf.reshape(videos, [-1, para.video_dimension])
     embed_video_inputs = tf.matmul(video_flat, video_embedding_w)
     embed_video_inputs = tf.reshape(embed_video_inputs,
-      [para.batch_size, para.video_frame_num//para.video_step, para.embedding_dimension])
+      [num_videos, para.video_frame_num//para.video_step, para.embedding_dimension])
 
     # apply dropout to inputs
     if self.is_train() and para.dropout_keep_prob < 1:
@@ -132,97 +168,102 @@ class S2VT(object):
     # initialize cost
     cost = tf.constant(0.0)
 
-    # paddings for 1st and 2nd layers
-    layer_1_padding = tf.zeros([para.batch_size, max_len-1, para.embedding_dimension])
-    layer_2_padding = tf.zeros([para.batch_size, para.video_frame_num//para.video_step, para.embedding_dimension])
-    
-    # preparing sequence length
-    video_frame_num = tf.constant(para.video_frame_num//para.video_step, dtype=tf.int32,
-                                  shape=[para.batch_size])
-    if not self.is_test():
-      sequence_length = tf.add(video_frame_num, caption_lens-1)
-    else:
-      sequence_length = tf.add(video_frame_num, max_len-1)
-    # reshape for rnn
-    sequence_length = tf.reshape(sequence_length, [-1])
-
-    # =================== layer 1 ===================
-    layer_1_inputs = tf.concat([embed_video_inputs, layer_1_padding], 1)
-    with tf.variable_scope('layer_1'):
-      layer_1_outputs, layer_1_final_state = tf.nn.dynamic_rnn(layer_1_cell,
-                                                  layer_1_inputs,
-                                                  sequence_length=sequence_length,
-                                                  dtype=tf.float32)
-    
-    # =================== layer 2 ===================
-    if self.is_train():
+    if self.is_train() and para.captions_per_video:
       caption_embed = tf.nn.embedding_lookup(word_embedding_w, target_captions_input)
-      layer_2_pad_and_embed = tf.concat([layer_2_padding, caption_embed], 1)
-      layer_2_inputs = tf.concat([layer_2_pad_and_embed, layer_1_outputs], 2)
+      layer_2_outputs = self.decode_captions(para, layer_1_cell, layer_2_cell,
+        embed_video_inputs, caption_embed, caption_lens, max_len)
     else:
-      layer_2_inputs = layer_1_outputs
-
-    layer_2_inputs = tf.transpose(layer_2_inputs, perm=[1,0,2]) # for time major unstack
-    layer_2_inputs_ta = tf.TensorArray(dtype=tf.float32,
-                                       size=para.video_frame_num//para.video_step+max_len-1)
-    layer_2_inputs_ta = layer_2_inputs_ta.unstack(layer_2_inputs)
-
-    if self.is_train():
-      def layer_2_loop_fn(time, cell_output, cell_state, loop_state):
-        emit_output = cell_output
-        if cell_output is None: # time == 0
-          next_cell_state = layer_2_cell.zero_state(para.batch_size, dtype=tf.float32)
-        else:
-          next_cell_state = cell_state
-        is_finished = (time >= sequence_length)
-        finished = tf.reduce_all(is_finished)
-        next_input = tf.cond(
-          finished,
-          lambda: tf.zeros([para.batch_size, para.embedding_dimension+para.hidden_units], dtype=tf.float32),
-          lambda: layer_2_inputs_ta.read(time))
-        return (is_finished, next_input, next_cell_state, emit_output, loop_state)
-    else:
-      def layer_2_loop_fn(time, cell_output, cell_state, loop_state):
-        def encode_input():
-          layer_2_inputs = layer_2_inputs_ta.read(time)
-          padding = tf.zeros([para.batch_size, para.embedding_dimension], dtype=tf.float32)
-          return tf.concat([padding, layer_2_inputs], 1)
-
-        def decode_input():
-          if cell_output is None:
-            return tf.zeros([para.batch_size, para.embedding_dimension+para.hidden_units], dtype=tf.float32)
+      # paddings for 1st and 2nd layers
+      layer_1_padding = tf.zeros([para.batch_size, max_len-1, para.embedding_dimension])
+      layer_2_padding = tf.zeros([para.batch_size, para.video_frame_num//para.video_step, para.embedding_dimension])
+    
+      # preparing sequence length
+      video_frame_num = tf.constant(para.video_frame_num//para.video_step, dtype=tf.int32,
+                                    shape=[para.batch_size])
+      if not self.is_test():
+        sequence_length = tf.add(video_frame_num, caption_lens-1)
+      else:
+        sequence_length = tf.add(video_frame_num, max_len-1)
+      # reshape for rnn
+      sequence_length = tf.reshape(sequence_length, [-1])
+
+      # =================== layer 1 ===================
+      layer_1_inputs = tf.concat([embed_video_inputs, layer_1_padding], 1)
+      with tf.variable_scope('layer_1'):
+        layer_1_outputs, layer_1_final_state = tf.nn.dynamic_rnn(layer_1_cell,
+                                                    layer_1_inputs,
+                                                    sequence_length=sequence_length,
+                                                    dtype=tf.float32)
+    
+      # =================== layer 2 ===================
+      if self.is_train():
+        caption_embed = tf.nn.embedding_lookup(word_embedding_w, target_captions_input)
+        layer_2_pad_and_embed = tf.concat([layer_2_padding, caption_embed], 1)
+        layer_2_inputs = tf.concat([layer_2_pad_and_embed, layer_1_outputs], 2)
+      else:
+        layer_2_inputs = layer_1_outputs
+
+      layer_2_inputs = tf.transpose(layer_2_inputs, perm=[1,0,2]) # for time major unstack
+      layer_2_inputs_ta = tf.TensorArray(dtype=tf.float32,
+                                         size=para.video_frame_num//para.video_step+max_len-1)
+      layer_2_inputs_ta = layer_2_inputs_ta.unstack(layer_2_inputs)
+
+      if self.is_train():
+        def layer_2_loop_fn(time, cell_output, cell_state, loop_state):
+          emit_output = cell_output
+          if cell_output is None: # time == 0
+            next_cell_state = layer_2_cell.zero_state(para.batch_size, dtype=tf.float32)
           else:
-            def is_begin():
-              begin_of_sentence = tf.ones([para.batch_size, para.embedding_dimension], dtype=tf.float32)
-              next_input = tf.concat([begin_of_sentence, layer_2_inputs_ta.read(time)], 1)
-              return next_input
-            def not_begin():
-              output_logit = tf.matmul(cell_output, word_decoding_w)
-              prediction = tf.argmax(output_logit, axis=1)
-              prediction_embed = tf.nn.embedding_lookup(word_embedding_w, prediction)
-              next_input = tf.concat([prediction_embed, layer_2_inputs_ta.read(time)], 1)
+            next_cell_state = cell_state
+          is_finished = (time >= sequence_length)
+          finished = tf.reduce_all(is_finished)
+          next_input = tf.cond(
+            finished,
+            lambda: tf.zeros([para.batch_size, para.embedding_dimension+para.hidden_units], dtype=tf.float32),
+            lambda: layer_2_inputs_ta.read(time))
+          return (is_finished, next_input, next_cell_state, emit_output, loop_state)
+      else:
+        def layer_2_loop_fn(time, cell_output, cell_state, loop_state):
+          def encode_input():
+            layer_2_inputs = layer_2_inputs_ta.read(time)
+            padding = tf.zeros([para.batch_size, para.embedding_dimension], dtype=tf.float32)
+            return tf.concat([padding, layer_2_inputs], 1)
+
+          def decode_input():
+            if cell_output is None:
+              return tf.zeros([para.batch_size, para.embedding_dimension+para.hidden_units], dtype=tf.float32)
+            else:
+              def is_begin():
+                begin_of_sentence = tf.ones([para.batch_size, para.embedding_dimension], dtype=tf.float32)
+                next_input = tf.concat([begin_of_sentence, layer_2_inputs_ta.read(time)], 1)
+                return next_input
+              def not_begin():
+                output_logit = tf.matmul(cell_output, word_decoding_w)
+                prediction = tf.argmax(output_logit, axis=1)
+                prediction_embed = tf.nn.embedding_lookup(word_embedding_w, prediction)
+                next_input = tf.concat([prediction_embed, layer_2_inputs_ta.read(time)], 1)
+                return next_input
+              begin = tf.equal(time,video_frame_num)
+              begin = tf.reduce_all(begin)
+              next_input = tf.cond(begin, is_begin, not_begin)
               return next_input
-            begin = tf.equal(time,video_frame_num)
-            begin = tf.reduce_all(begin)
-            next_input = tf.cond(begin, is_begin, not_begin)
-            return next_input
-
-        emit_output = cell_output
-        if cell_output is None: # time == 0
-          next_cell_state = layer_2_cell.zero_state(para.batch_size, dtype=tf.float32)
-        else:
-          next_cell_state = cell_state
-        all_finished = (time >= (sequence_length-1))
-        start_decoding = (time >= video_frame_num)
-        start_decoding = tf.reduce_all(start_decoding)
-        next_input = tf.cond(start_decoding, decode_input, encode_input)
-
-        return (all_finished, next_input, next_cell_state, emit_output, loop_state)
-
-    layer_2_outputs_ta, layer_2_final_state, _ = tf.nn.raw_rnn(layer_2_cell, layer_2_loop_fn)
-    layer_2_outputs = layer_2_outputs_ta.stack()
-    layer_2_outputs = layer_2_outputs[para.video_frame_num//para.video_step:, :, :]
-    layer_2_outputs = tf.transpose(layer_2_outputs, perm=[1,0,2]) # batch_size x time x embed_dim
+
+          emit_output = cell_output
+          if cell_output is None: # time == 0
+            next_cell_state = layer_2_cell.zero_state(para.batch_size, dtype=tf.float32)
+          else:
+            next_cell_state = cell_state
+          all_finished = (time >= (sequence_length-1))
+          start_decoding = (time >= video_frame_num)
+          start_decoding = tf.reduce_all(start_decoding)
+          next_input = tf.cond(start_decoding, decode_input, encode_input)
+
+          return (all_finished, next_input, next_cell_state, emit_output, loop_state)
+
+      layer_2_outputs_ta, layer_2_final_state, _ = tf.nn.raw_rnn(layer_2_cell, layer_2_loop_fn)
+      layer_2_outputs = layer_2_outputs_ta.stack()
+      layer_2_outputs = layer_2_outputs[para.video_frame_num//para.video_step:, :, :]
+      layer_2_outputs = tf.transpose(layer_2_outputs, perm=[1,0,2]) # batch_size x time x embed_dim
 
     if self.is_train():
       layer_2_outputs = tf.reshape(layer_2_outputs, [-1, para.hidden_units])
@@ -246,9 +287,34 @@ class S2VT(object):
       layer_2_output_logit = tf.matmul(layer_2_outputs, word_decoding_w)
       layer_2_output_logit = tf.reshape(layer_2_output_logit, [para.batch_size, -1, para.vocab_size])
       self._prob = tf.nn.softmax(layer_2_output_logit)
+      self._predictions = tf.argmax(layer_2_output_logit, axis=2)
 
   # ======================== end of __init__ ======================== #
 
+  def decode_captions(self, para, layer_1_cell, layer_2_cell, embed_video_inputs,
+                      caption_embed, caption_lens, max_len):
+    # the inputs of the 1st layer and the first video_frame_num steps of
+    # the 2nd one do not depend on captions, so each video is run once and
+    # its outputs and states are repeated for the decoding of its captions
+    num_videos = para.batch_size//para.captions_per_video
+    frame_num = para.video_frame_num//para.video_step
+    layer_1_padding = tf.zeros([num_videos, max_len-1, para.embedding_dimension])
+    layer_1_inputs = tf.concat([embed_video_inputs, layer_1_padding], 1)
+    with tf.variable_scope('layer_1'):
+      layer_1_outputs, _ = tf.nn.dynamic_rnn(layer_1_cell, layer_1_inputs, dtype=tf.float32)
+
+    layer_2_padding = tf.zeros([num_videos, frame_num, para.embedding_dimension])
+    encode_inputs = tf.concat([layer_2_padding, layer_1_outputs[:, :frame_num, :]], 2)
+    _, encode_state = tf.nn.dynamic_rnn(layer_2_cell, encode_inputs, dtype=tf.float32)
+
+    decode_inputs = tf.concat([caption_embed,
+      rows.repeat(layer_1_outputs[:, frame_num:, :], para.captions_per_video)], 2)
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      layer_2_outputs, _ = tf.nn.dynamic_rnn(layer_2_cell, decode_inputs,
+        sequence_length=tf.maximum(caption_lens-1, 0),
+        initial_state=rows.repeat(encode_state, para.captions_per_video))
+    return layer_2_outputs
+
   def is_train(self): return self._para.mode == 0
   def is_valid(self): return self._para.mode == 1
   def  is_test(self): return self._para.mode == 2
@@ -260,44 +326,53 @@ class S2VT(object):
   @property
   def prob(self): return self._prob
   @property
+  def predictions(self): return self._predictions
+  @property
   def val1(self):  return self._val1
   @property
   def val2(self):  return self._val2
 
-  def get_single_example(self, para):
+  def get_files(self):
     if self.is_train():
       file_list_path = 'MLDS_hw2_data/training_data/Training_Data_TFR/training_list.txt'
       filenames = open(file_list_path).read().splitlines()
-      files = ['MLDS_hw2_data/training_data/Training_Data_TFR/'+filename for filename in filenames]
-      file_queue = tf.train.string_input_producer(files, shuffle=True)
+      return ['MLDS_hw2_data/training_data/Training_Data_TFR/'+filename for filename in filenames]
     else:
-      file_list_path = 'MLDS_hw2_data/testing_data/Testing_Data_TFR/testing_list.txt'
-      filenames = open(file_list_path).read().splitlines()
-      files = ['MLDS_hw2_data/testing_data/Testing_Data_TFR/'+filename for filename in filenames]
-      file_queue = tf.train.string_input_producer(files, shuffle=False)
+      return testing_files()
 
+  def get_single_example(self, para):
+    file_queue = tf.train.string_input_producer(self.get_files(), shuffle=self.is_train())
     reader = tf.TFRecordReader()
     _, serialized_example = reader.read(file_queue)
+    return self.parse_example(para, serialized_example)
 
+  def parse_example(self, para, serialized_example):
+    features = {'caption': tf.VarLenFeature(tf.int64)} if self.is_train() else {}
+    video, features = self.parse_video(para, serialized_example, features)
     if self.is_train():
-      features = tf.parse_single_example(
-        serialized_example,
-        features={
-          'video': tf.FixedLenFeature([para.video_frame_num*para.video_dimension], tf.float32),
-          'caption': tf.VarLenFeature(tf.int64),
-        })
-      video = tf.reshape(features['video'], [-1, para.video_dimension])[::para.video_step]
       caption = features['caption']
       return video, caption, tf.shape(video)[0], tf.shape(caption)[0]
     else:
-      features = tf.parse_single_example(
-        serialized_example,
-        features={
-          'video': tf.FixedLenFeature([para.video_frame_num*para.video_dimension], tf.float32)
-        })
-      video = tf.reshape(features['video'], [-1, para.video_dimension])[::para.video_step]
       return video, tf.shape(video)[0]
 
+  def parse_video(self, para, serialized_example, features=None):
+    return feature_store.parse_video(serialized_example, self._store,
+      para.video_dimension, para.video_step, para.video_frame_num, features)
+
+  def parse_group(self, para, serialized):
+    # the video of records of the same video and their captions, padded
+    # with captions of length 0 to captions_per_video rows
+    video, _ = self.parse_video(para, serialized[0])
+    features = tf.parse_example(serialized, features={'caption': tf.VarLenFeature(tf.int64)})
+    captions = tf.sparse_tensor_to_dense(features['caption'])
+    caption_lens = tf.reduce_sum(tf.to_int32(tf.not_equal(captions, 0)), 1) # <pad> is 0
+    padding = para.captions_per_video-tf.shape(captions)[0]
+    captions = tf.pad(captions, [[0, padding], [0, 0]])
+    caption_lens = tf.pad(caption_lens, [[0, padding]])
+    captions.set_shape([para.captions_per_video, None])
+    caption_lens.set_shape([para.captions_per_video])
+    return video, captions, tf.shape(video)[0], caption_lens
+
 def run_epoch(sess, model, args):
   fetches = {}
   if not model.is_test():
@@ -307,19 +382,14 @@ def run_epoch(sess, model, args):
     vals = sess.run(fetches)
     return np.exp(vals['cost'])
   else:
-    fetches['prob'] = model.prob
+    # the argmax is taken in the graph, only word ids are fetched
+    fetches['predictions'] = model.predictions
     vals = sess.run(fetches)
-    prob = vals['prob']
-    bests = []
-    for i in range(prob.shape[0]):
-      ans = []
-      for j in range(prob.shape[1]):
-        mx_id = np.argmax(prob[i, j, :])
-        if mx_id == EOS:
-          break
-        ans.append(vocab_dictionary[str(mx_id)])
-      bests.append(ans)
-    return bests
+    predictions = vals['predictions']
+    # mask the first <EOS> of each caption and everything after it
+    ended = np.cumsum(predictions == EOS, axis=1) > 0
+    return [ [ vocab_dictionary[str(word_id)] for word_id in caption[~end] ]
+             for caption, end in zip(predictions, ended) ]
 
 if __name__ == '__main__':
   argparser = argparse.ArgumentParser(description='S2VT encoder and decoder')
@@ -374,7 +444,20 @@ if __name__ == '__main__':
   argparser.add_argument('-vs', '--video_step',
     type=int, default=default_video_step,
     help='Choose a frame per step. (default:%d)' %default_video_step)
+  argparser.add_argument('-td', '--tf_data', action='store_true',
+    help='read TFRecord files with the tf.data pipeline of tf_input.py instead of queue runners')
+  argparser.add_argument('-ca', '--cache_data', action='store_true',
+    help='with --tf_data, keep parsed records in memory after the first epoch')
+  argparser.add_argument('-cpv', '--captions_per_video',
+    type=int, default=default_captions_per_video,
+    help='with --tf_data, batch videos with up to CAPTIONS_PER_VIDEO captions each and '
+         'encode each video once (default:%d)' %default_captions_per_video)
+  argparser.add_argument('-tbs', '--test_batch_size',
+    type=int, default=default_test_batch_size,
+    help='testing videos decoded at once (default:%d)' %default_test_batch_size)
   args = argparser.parse_args()
+  if args.captions_per_video and (not args.tf_data or args.batch_size%args.captions_per_video):
+    argparser.error('--captions_per_video needs --tf_data and must divide --batch_size')
 
 
   print('S2VT start...\n')
@@ -401,7 +484,9 @@ if __name__ == '__main__':
       test_args = copy.deepcopy(args)
       with tf.variable_scope('model', reuse=True, initializer=initializer):
         test_args.mode = default_testing_mode
-        test_args.batch_size = 1
+        # a few large batches, the last one padded with the first videos again
+        test_args.testing_video_num = len(testing_files())
+        test_args.batch_size = min(args.test_batch_size, test_args.testing_video_num)
         test_model = S2VT(para=test_args)
 
     config = tf.ConfigProto()
@@ -416,9 +501,9 @@ if __name__ == '__main__':
 
       # testing
       results = []
-      for i in range(default_testing_video_num):
+      while len(results) < test_args.testing_video_num:
         results.extend(run_epoch(sess, test_model, test_args))
-      results = [ ' '.join(result[:-1]) for result in results ]
+      results = [ ' '.join(result[:-1]) for result in results[:test_args.testing_video_num] ]
       for result in results: print(result)
 
     # compute BLEU score
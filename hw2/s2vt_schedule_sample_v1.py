@@ -9,6 +9,8 @@ import json
 import tensorflow.contrib.seq2seq as seq2seq
 from tensorflow.contrib.rnn import LSTMCell, LSTMStateTuple, GRUCell
 from tensorflow.contrib.seq2seq import sequence_loss as sequence_loss
+import tf_input
+import feature_store
 
 default_rnn_cell_type         = 2    # 0: BsicRNN, 1: BasicLSTM, 2: FullLSTM, 3: GRU
 default_video_dimension       = 4096 # dimension of each frame
@@ -86,10 +88,23 @@ class S2VT(object):
         [rnn_cell() for _ in range(para.layer_number)])
 
     # get data in batches
+    self._store = feature_store.load(self.get_files())
+    if self._store is not None:
+      # frames of the store may be projected to fewer dimensions
+      para.video_dimension = self._store.dim
     if self.is_train():
-      video, caption, video_len, caption_len = self.get_single_example(para)
-      videos, captions, video_lens, caption_lens = tf.train.batch([video, caption, video_len, caption_len],
-        batch_size=para.batch_size, dynamic_pad=True)
+      if para.tf_data:
+        def parse(serialized_example):
+          video, caption, video_len, caption_len = self.parse_example(para, serialized_example)
+          return video, tf.sparse_tensor_to_dense(caption), video_len, caption_len
+        videos, target_captions, video_lens, caption_lens = tf_input.batch(self.get_files(),
+          parse, para.batch_size, cache=para.cache_data)
+      else:
+        video, caption, video_len, caption_len = self.get_single_example(para)
+        videos, captions, video_lens, caption_lens = tf.train.batch([video, caption, video_len, caption_len],
+          batch_size=para.batch_size, dynamic_pad=True)
+        # sparse tensor cannot be sliced
+        target_captions = tf.sparse_tensor_to_dense(captions)
       
       # construct caption mask for loss computing
       caption_lens = tf.to_int32(caption_lens)
@@ -97,14 +112,17 @@ class S2VT(object):
       max_len = tf.reduce_max(caption_lens)
       caption_mask = tf.sequence_mask(caption_lens_reshape-1, max_len-1, dtype=tf.float32)
       
-      # sparse tensor cannot be sliced
-      target_captions = tf.sparse_tensor_to_dense(captions)
       target_captions_input  = target_captions[:,  :-1] # start from <BOS>
       target_captions_output = target_captions[:, 1:  ] # end by <EOS>
     else:
-      video, video_len = self.get_single_example(para)
-      videos, video_lens = tf.train.batch([video, video_len],
-        batch_size=para.batch_size, dynamic_pad=True)
+      if para.tf_data:
+        videos, video_lens = tf_input.batch(self.get_files(),
+          lambda serialized_example: self.parse_example(para, serialized_example),
+          para.batch_size, shuffle=False, cache=para.cache_data)
+      else:
+        video, video_len = self.get_single_example(para)
+        videos, video_lens = tf.train.batch([video, video_len],
+          batch_size=para.batch_size, dynamic_pad=True)
       max_len = para.max_caption_length
 
     # video and word embeddings as well as word decoding
@@ -294,38 +312,30 @@ class S2VT(object):
   @property
   def val2(self):  return self._val2
 
-  def get_single_example(self, para):
+  def get_files(self):
     if self.is_train():
       file_list_path = 'MLDS_hw2_data/training_data/Training_Data_TFR/training_list.txt'
       filenames = open(file_list_path).read().splitlines()
-      files = ['MLDS_hw2_data/training_data/Training_Data_TFR/'+filename for filename in filenames]
-      file_queue = tf.train.string_input_producer(files, shuffle=True)
+      return ['MLDS_hw2_data/training_data/Training_Data_TFR/'+filename for filename in filenames]
     else:
       file_list_path = 'MLDS_hw2_data/testing_data/Testing_Data_TFR/testing_list.txt'
       filenames = open(file_list_path).read().splitlines()
-      files = ['MLDS_hw2_data/testing_data/Testing_Data_TFR/'+filename for filename in filenames]
-      file_queue = tf.train.string_input_producer(files, shuffle=False)
+      return ['MLDS_hw2_data/testing_data/Testing_Data_TFR/'+filename for filename in filenames]
 
+  def get_single_example(self, para):
+    file_queue = tf.train.string_input_producer(self.get_files(), shuffle=self.is_train())
     reader = tf.TFRecordReader()
     _, serialized_example = reader.read(file_queue)
+    return self.parse_example(para, serialized_example)
 
+  def parse_example(self, para, serialized_example):
+    features = {'caption': tf.VarLenFeature(tf.int64)} if self.is_train() else {}
+    video, features = feature_store.parse_video(serialized_example, self._store,
+      para.video_dimension, para.video_step, para.video_frame_num, features)
     if self.is_train():
-      features = tf.parse_single_example(
-        serialized_example,
-        features={
-          'video': tf.FixedLenFeature([para.video_frame_num*para.video_dimension], tf.float32),
-          'caption': tf.VarLenFeature(tf.int64),
-        })
-      video = tf.reshape(features['video'], [-1, para.video_dimension])[::para.video_step]
       caption = features['caption']
       return video, caption, tf.shape(video)[0], tf.shape(caption)[0]
     else:
-      features = tf.parse_single_example(
-        serialized_example,
-        features={
-          'video': tf.FixedLenFeature([para.video_frame_num*para.video_dimension], tf.float32)
-        })
-      video = tf.reshape(features['video'], [-1, para.video_dimension])[::para.video_step]
       return video, tf.shape(video)[0]
 
 def run_epoch(sess, model, args):
@@ -404,6 +414,10 @@ if __name__ == '__main__':
   argparser.add_argument('-vs', '--video_step',
     type=int, default=default_video_step,
     help='Choose a frame per step. (default:%d)' %default_video_step)
+  argparser.add_argument('-td', '--tf_data', action='store_true',
+    help='read TFRecord files with the tf.data pipeline of tf_input.py instead of queue runners')
+  argparser.add_argument('-ca', '--cache_data', action='store_true',
+    help='with --tf_data, keep parsed records in memory after the first epoch')
   argparser.add_argument('-ss', '--schedule_sample_porb',
     type=float, default=default_schedule_sample_porb,
     help='scheduled sampling probability. (default:%d)' %default_schedule_sample_porb)
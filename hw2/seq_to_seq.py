@@ -10,6 +10,23 @@ from tensorflow.contrib.seq2seq.python.ops.attention_decoder_fn \
 import tensorflow.contrib.seq2seq as seq2seq
 from tensorflow.contrib.seq2seq import sequence_loss as sequence_loss
 from tensorflow.contrib.layers import legacy_fully_connected as fully_connected
+import tf_input
+import feature_store
+import rows
+
+def backtrack(tokens, parents, best):
+  '''token ids of the best beam of each video, following the beams back
+  from the last step; tokens and parents hold the token and the parent
+  beam of every beam, the row b*beam_size+k being the k-th beam of video
+  b, at every step'''
+  beam_size = len(tokens)//len(best)
+  beams = np.array(best)
+  captions = np.zeros((len(best), tokens.shape[1]), dtype=tokens.dtype)
+  for t in reversed(range(tokens.shape[1])):
+    row = np.arange(len(best))*beam_size+beams
+    captions[:, t] = tokens[row, t]
+    beams = parents[row, t]
+  return captions
 
 class S2S(object):
 
@@ -45,16 +62,46 @@ class S2S(object):
         tf.contrib.rnn.MultiRNNCell([rnn_cell(1) for _ in range(para.layer_num)])
 
     #feed in data in batches
+    self._store = feature_store.load(self.get_filenames(para))
+    #frames of the store may be projected to fewer dimensions
+    if self._store is not None: para.video_dim = self._store.dim
     if not self.is_test():
-      video, caption, v_len, c_len = self.get_single_example(para)
-      videos, captions, v_lens, c_lens =\
-          tf.train.batch([video, caption, v_len, c_len],
-                         batch_size=para.batch_size, dynamic_pad=True)
-      #sparse tensor cannot be sliced
-      targets = tf.sparse_tensor_to_dense(captions)
+      if para.captions_per_video:
+        #a row of videos for each video, a row of targets for each caption
+        videos, targets, v_lens, c_lens =\
+            tf_input.batch(self.get_filenames(para),
+                           lambda serialized:
+                           self.parse_group(para, serialized),
+                           para.batch_size//para.captions_per_video,
+                           cache=para.cache_data,
+                           group_size=para.captions_per_video)
+        targets = tf.reshape(targets, [para.batch_size, -1])
+        c_lens = tf.reshape(c_lens, [-1])
+      elif para.tf_data:
+        def parse(serialized_example):
+          video, caption, v_len, c_len =\
+              self.parse_example(para, serialized_example)
+          return video, tf.sparse_tensor_to_dense(caption), v_len, c_len
+        videos, targets, v_lens, c_lens =\
+            tf_input.batch(self.get_filenames(para), parse, para.batch_size,
+                           cache=para.cache_data)
+      else:
+        video, caption, v_len, c_len = self.get_single_example(para)
+        videos, captions, v_lens, c_lens =\
+            tf.train.batch([video, caption, v_len, c_len],
+                           batch_size=para.batch_size, dynamic_pad=True)
+        #sparse tensor cannot be sliced
+        targets = tf.sparse_tensor_to_dense(captions)
       decoder_in = targets[:, :-1]
       decoder_out = targets[:, 1:]
       c_lens = tf.to_int32(c_lens)
+    elif para.tf_data:
+      videos, v_lens =\
+          tf_input.batch(self.get_filenames(para),
+                         lambda serialized_example:
+                         self.parse_example(para, serialized_example),
+                         para.batch_size, shuffle=False,
+                         cache=para.cache_data)
     else:
       video, v_len = self.get_single_example(para)
       videos, v_lens =\
@@ -90,6 +137,13 @@ class S2S(object):
                               for f_st, b_st in zip(encoder_states[0],
                                                     encoder_states[1])])
       encoder_outputs = tf.concat([encoder_outputs[0], encoder_outputs[1]], 2)
+    #each video is encoded once for all of its captions, or for all of the
+    #beams searching its caption
+    num_copies = para.beam_search if self.is_test()\
+        else para.captions_per_video
+    if num_copies > 1:
+      encoder_outputs, encoder_states =\
+        rows.repeat((encoder_outputs, encoder_states), num_copies)
 
     with tf.variable_scope('softmax'):
       softmax_w = tf.get_variable('w', [para.hidden_size*para.fac,
@@ -107,33 +161,67 @@ class S2S(object):
                                   attention_option=at_option,
                                   num_units=para.hidden_size*para.fac)
     if self.is_test():
-      if para.attention:
-        decoder_fn_inference = seq2seq.attention_decoder_fn_inference(
-            output_fn=output_fn,
-            encoder_state=encoder_states,
-            attention_keys=at_keys,
-            attention_values=at_vals,
-            attention_score_fn=at_score,
-            attention_construct_fn=at_cons,
-            embeddings=W_E,
-            start_of_sequence_id=1,
-            end_of_sequence_id=2,
-            maximum_length=30,
-            num_decoder_symbols=para.vocab_size)
-      else:
-        decoder_fn_inference = seq2seq.simple_decoder_fn_inference(
-            output_fn=output_fn,
-            encoder_state=encoder_states,
-            embeddings=W_E,
-            start_of_sequence_id=1,
-            end_of_sequence_id=2,
-            maximum_length=30,
-            num_decoder_symbols=para.vocab_size)
-      with tf.variable_scope('decode', reuse=True):
-        decoder_logits, _, _ =\
+      #the row b*beam_size+k is the k-th beam of video b
+      beam_size = para.beam_search
+      num_beams = para.batch_size*beam_size
+      eos_only = tf.tile(tf.expand_dims(tf.one_hot(2, para.vocab_size,
+                                                   on_value=0.,
+                                                   off_value=-1e9), 0),
+                         [num_beams, 1])
+
+      def decoder_fn_beam(time, cell_state, cell_input,
+                          cell_output, context):
+        if cell_output is None:
+          #only the first beam of each video is alive at the start
+          log_probs = tf.tile(tf.one_hot(0, beam_size, on_value=0.,
+                                         off_value=-1e9), [para.batch_size])
+          finished = tf.zeros([num_beams], dtype=tf.bool)
+          lengths = tf.zeros([num_beams], dtype=tf.int32)
+          tokens = tf.ones([num_beams], dtype=tf.int32)
+          cell_state = encoder_states
+          emit = tf.zeros([2], dtype=tf.int32)
+          if para.attention: attention = _init_attention(encoder_states)
+        else:
+          log_probs, finished, lengths, attention = context
+          if para.attention:
+            cell_output = attention = at_cons(cell_output, at_keys, at_vals)
+          #finished beams only go on with <eos>, at no cost
+          step_log_probs = tf.where(finished, eos_only,
+                                    tf.nn.log_softmax(output_fn(cell_output)))
+          scores = tf.reshape(tf.expand_dims(log_probs, 1)+step_log_probs,
+                              [para.batch_size, -1])
+          log_probs, best = tf.nn.top_k(scores, beam_size)
+          log_probs = tf.reshape(log_probs, [-1])
+          beams = tf.reshape(best//para.vocab_size, [-1])
+          tokens = tf.reshape(best%para.vocab_size, [-1])
+          parents = beams+tf.range(num_beams)//beam_size*beam_size
+          cell_state = rows.gather(cell_state, parents)
+          if para.attention: attention = tf.gather(attention, parents)
+          was_finished = tf.gather(finished, parents)
+          lengths = tf.gather(lengths, parents)+\
+              tf.to_int32(tf.logical_not(was_finished))
+          finished = tf.logical_or(was_finished, tf.equal(tokens, 2))
+          emit = tf.stack([tokens, beams], 1)
+        next_input = tf.gather(W_E, tokens)
+        if para.attention:
+          next_input = tf.concat([next_input, attention], 1)
+        else: attention = tf.zeros([num_beams, 0])
+        #all beams stop together, raw_rnn would not reorder finished rows
+        done = tf.logical_or(tf.reduce_all(finished), time > 30)
+        return (tf.fill([num_beams], done), cell_state, next_input, emit,
+                (log_probs, finished, lengths, attention))
+
+      #reuse is inherited, the decoder is created here when there is no
+      #training graph
+      with tf.variable_scope('decode'):
+        steps, _, (log_probs, _, lengths, _) =\
           seq2seq.dynamic_rnn_decoder(cell=decoder_cell,
-                                    decoder_fn=decoder_fn_inference)
-      self._prob = tf.nn.softmax(decoder_logits)
+                                      decoder_fn=decoder_fn_beam)
+      #length normalized scores choose the caption of each video
+      scores = log_probs/tf.pow(tf.to_float(tf.maximum(lengths, 1)),
+                                para.length_penalty)
+      best = tf.argmax(tf.reshape(scores, [para.batch_size, beam_size]), 1)
+      self._beams = (steps[:, :, 0], steps[:, :, 1], best)
 
     else:
       global_step = tf.contrib.framework.get_or_create_global_step()
@@ -191,35 +279,57 @@ class S2S(object):
   def is_valid(self): return self._para.mode == 1
   def is_test(self): return self._para.mode == 2
 
-  def get_single_example(self, para):
-    '''get one example from TFRecorder file using tf default queue runner'''
+  def get_filenames(self, para):
+    '''TFRecorder files of the mode'''
     if self.is_test():
       filelist = open(para.inference_list, 'r').read().splitlines()
-      filenames = [fl for fl in filelist]
-      f_queue = tf.train.string_input_producer(filenames, shuffle=False)
-    else:
-      filelist = open(para.train_list, 'r').read().splitlines()
-      filenames = [fl for fl in filelist]
-      if self.is_train(): filenames = filenames[:para.train_num]
-      else: filenames = filenames[para.train_num:]
-      f_queue = tf.train.string_input_producer(filenames, shuffle=True)
+      return [fl for fl in filelist]
+    filelist = open(para.train_list, 'r').read().splitlines()
+    filenames = [fl for fl in filelist]
+    if self.is_train(): return filenames[:para.train_num]
+    else: return filenames[para.train_num:]
+
+  def get_single_example(self, para):
+    '''get one example from TFRecorder file using tf default queue runner'''
+    f_queue = tf.train.string_input_producer(self.get_filenames(para),
+                                             shuffle=not self.is_test())
     reader = tf.TFRecordReader()
     _, serialized_example = reader.read(f_queue)
-
+    return self.parse_example(para, serialized_example)
+
+  def parse_example(self, para, serialized_example):
+    '''video of an example and its length, with its caption as a sparse
+    tensor and the caption length unless testing'''
+    features = {} if self.is_test() else\
+        {'caption':tf.VarLenFeature(tf.int64)}
+    video, feature = self.parse_video(para, serialized_example, features)
     if self.is_test():
-      feature = tf.parse_single_example(serialized_example, features={
-        'video': tf.VarLenFeature(tf.float32)})
-      video = tf.sparse_tensor_to_dense(feature['video'])
-      video = tf.reshape(video, [-1, para.video_dim])[::para.video_step]
       return video, tf.shape(video)[0]
-    else:
-      feature = tf.parse_single_example(serialized_example, features={
-        'video':tf.VarLenFeature(tf.float32),
-        'caption':tf.VarLenFeature(tf.int64)})
-      video = tf.sparse_tensor_to_dense(feature['video'])
-      video = tf.reshape(video, [-1, para.video_dim])[::para.video_step]
-      caption = feature['caption']
-      return video, caption, tf.shape(video)[0], tf.shape(caption)[0]-1
+    caption = feature['caption']
+    return video, caption, tf.shape(video)[0], tf.shape(caption)[0]-1
+
+  def parse_video(self, para, serialized_example, features=None):
+    '''video of an example with its other features'''
+    return feature_store.parse_video(serialized_example, self._store,
+                                     para.video_dim, para.video_step,
+                                     features=features)
+
+  def parse_group(self, para, serialized):
+    '''video of a group of examples of the same video, their captions
+    padded to para.captions_per_video rows, the video length and the
+    caption lengths, 0 for padding rows'''
+    video, _ = self.parse_video(para, serialized[0])
+    feature = tf.parse_example(serialized, features={
+      'caption':tf.VarLenFeature(tf.int64)})
+    captions = tf.sparse_tensor_to_dense(feature['caption'])
+    #<pad> is 0 and never in a caption
+    c_lens = tf.reduce_sum(tf.to_int32(tf.not_equal(captions, 0)), 1)-1
+    padding = para.captions_per_video-tf.shape(captions)[0]
+    captions = tf.pad(captions, [[0, padding], [0, 0]])
+    c_lens = tf.pad(c_lens, [[0, padding]])
+    captions.set_shape([para.captions_per_video, None])
+    c_lens.set_shape([para.captions_per_video])
+    return video, captions, tf.shape(video)[0], c_lens
 
   @property
   def cost(self): return self._cost
@@ -228,6 +338,8 @@ class S2S(object):
   @property
   def prob(self): return self._prob
   @property
+  def beams(self): return self._beams
+  @property
   def val1(self): return self._val1
 
 def run_epoch(sess, model, args):
@@ -241,26 +353,33 @@ def run_epoch(sess, model, args):
     return np.exp(vals['cost'])
 
   else:
-    fetches['prob'] = model.prob
+    fetches['beams'] = model.beams
     vals = sess.run(fetches)
-    prob = vals['prob']
+    captions = backtrack(*vals['beams'])
 
     bests = []
-    for i in range(prob.shape[0]):
-      ps, ans = [], []
-      for j in range(prob.shape[1]):
-        mx_i = np.argmax(prob[i, j, :])
+    for caption in captions:
+      ans = []
+      for mx_i in caption:
         if mx_i == 2:
           break
         ans.append(dct[mx_i])
       bests.append(ans)
     return bests
 
+def predict(sess, model, args):
+  '''captions of all testing videos, batches wrap around the testing data'''
+  results = []
+  while len(results) < args.test_num:
+    results.extend(run_epoch(sess, model, args))
+  return [ ' '.join(result[:-1]) for result in results[:args.test_num] ]
+
 if __name__ == '__main__':
 
   #default values (in alphabetic order)
   default_batch_size = 145
   default_beam_size = 1
+  default_length_penalty = 1.
   default_embed_dim = 512
   default_hidden_size = 256
   default_inference_list = 'inference_list.txt'
@@ -282,6 +401,7 @@ if __name__ == '__main__':
   default_video_step = 5
   default_vocab_file = 'train_tfrdata/vocab.txt'
   default_attention = 0
+  default_captions_per_video = 0
   #default_wordvec_src = 3
   optimizers = [tf.train.GradientDescentOptimizer, tf.train.AdadeltaOptimizer,
                 tf.train.AdagradOptimizer, tf.train.MomentumOptimizer,
@@ -354,6 +474,10 @@ if __name__ == '__main__':
                       type=int, default=default_max_epoch,
                       nargs='?', help='Maximum epoch to be trained.'
                       '(default:%d)'%default_max_epoch)
+  parser.add_argument('-io', '--inference_only', action='store_true',
+                      help='Only build the testing graph and restore the '
+                      'trained weights from logs/ to predict, implied by '
+                      '--max_epoch 0.')
   parser.add_argument('-tn', '--train_num',
                       type=int, default=default_train_num,
                       nargs='?', help='Number of files out of the total 1450'
@@ -384,6 +508,16 @@ if __name__ == '__main__':
   parser.add_argument('-b', '--beam_search', type=int,
                       default=default_beam_size, nargs='?',
                       help='Size of beam search.(default:%d)'%default_beam_size)
+  parser.add_argument('-lp', '--length_penalty', type=float,
+                      default=default_length_penalty,
+                      help='Beam scores are divided by the caption length '
+                      'to this power.(default:%.1f)'%default_length_penalty)
+  parser.add_argument('-td', '--tf_data', action='store_true',
+                      help='Read TFRecorder files with the tf.data pipeline '
+                      'of tf_input.py instead of queue runners.')
+  parser.add_argument('-ca', '--cache_data', action='store_true',
+                      help='With --tf_data, keep parsed records in memory '
+                      'after the first pass.')
   parser.add_argument('-vf', '--vocab_file', type=str, nargs='?',
                       default=default_vocab_file, help='List all train data. '
                       '(default:%s)'%default_vocab_file)
@@ -395,11 +529,25 @@ if __name__ == '__main__':
                       type=str, default=default_inference_list, nargs='?',
                       help='List all inference data (default:%s)'
                       %default_inference_list)
+  parser.add_argument('-cpv', '--captions_per_video',
+                      type=int, default=default_captions_per_video,
+                      help='With --tf_data, batch BATCH_SIZE/CAPTIONS_PER_'
+                      'VIDEO videos with up to CAPTIONS_PER_VIDEO captions '
+                      'each, encoding each video once. 0 batches captions '
+                      'one by one. (default:%d)'%default_captions_per_video)
   parser.add_argument('-of', '--output_filename',
                       type=str, default=default_output_filename, nargs='?',
                       help='Filename of the final prediction.'
                       '(default:%s)'%default_output_filename)
   args = parser.parse_args()
+  if args.beam_search < 1:
+    parser.error('--beam_search must be at least 1')
+  if args.captions_per_video and (not args.tf_data or
+                                  args.batch_size%args.captions_per_video):
+    parser.error('--captions_per_video needs --tf_data and must divide '
+                 '--batch_size')
+  if args.max_epoch == 0:
+    args.inference_only = True
 
   #calculate real epochs
   print('training with %.3f epochs!'%((args.batch_size*args.max_epoch)/1450))
@@ -412,43 +560,61 @@ if __name__ == '__main__':
     initializer = tf.random_uniform_initializer(-args.init_scale,
                                                 args.init_scale)
     #mode: 0->train, 1->valid, 2->test
-    with tf.name_scope('train'):
-      train_args = copy.deepcopy(args)
-      with tf.variable_scope('model', reuse=None, initializer=initializer):
-        train_args.mode = 0
-        train_model = S2S(para=train_args)
-    if args.train_num < 1450:
-      with tf.name_scope('valid'):
-        valid_args = copy.deepcopy(args)
-        with tf.variable_scope('model', reuse=True, initializer=initializer):
-          valid_args.mode = 1
-          valid_model = S2S(para=valid_args)
+    if not args.inference_only:
+      with tf.name_scope('train'):
+        train_args = copy.deepcopy(args)
+        with tf.variable_scope('model', reuse=None, initializer=initializer):
+          train_args.mode = 0
+          train_model = S2S(para=train_args)
+      if args.train_num < 1450:
+        with tf.name_scope('valid'):
+          valid_args = copy.deepcopy(args)
+          with tf.variable_scope('model', reuse=True, initializer=initializer):
+            valid_args.mode = 1
+            valid_model = S2S(para=valid_args)
     with tf.name_scope('test'):
       test_args = copy.deepcopy(args)
-      with tf.variable_scope('model', reuse=True, initializer=initializer):
+      #without the training graph, the testing graph creates the variables
+      with tf.variable_scope('model', reuse=None if args.inference_only
+                             else True, initializer=initializer):
         test_args.mode = 2
-        test_args.batch_size = 1
+        #a few large batches decode all testing videos
+        test_args.test_num =\
+          len(open(args.inference_list, 'r').read().splitlines())
+        test_args.batch_size = min(args.batch_size, test_args.test_num)
         test_model = S2S(para=test_args)
 
     config = tf.ConfigProto()
     config.gpu_options.per_process_gpu_memory_fraction = 0.5
-    sv = tf.train.Supervisor(logdir='logs/')
-    with sv.managed_session(config=config) as sess:
-
-      for i in range(1, args.max_epoch+1):
-        train_perplexity = run_epoch(sess, train_model, train_args)
-        if i%args.info_epoch == 0:
-          print('Epoch: %d Train Perplexity: %.4f'%(i, train_perplexity))
-        if args.train_num < 1450:
-          valid_perplexity = run_epoch(sess, valid_model, valid_args)
+    if args.inference_only:
+      #only variables of the testing graph are restored, logs/ is left
+      #untouched
+      checkpoint = tf.train.latest_checkpoint('logs/')
+      if checkpoint is None:
+        sys.exit('no checkpoint found in logs/')
+      saver = tf.train.Saver(tf.global_variables())
+      with tf.Session(config=config) as sess:
+        saver.restore(sess, checkpoint)
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+        results = predict(sess, test_model, test_args)
+        coord.request_stop()
+        coord.join(threads)
+    else:
+      sv = tf.train.Supervisor(logdir='logs/')
+      with sv.managed_session(config=config) as sess:
+
+        for i in range(1, args.max_epoch+1):
+          train_perplexity = run_epoch(sess, train_model, train_args)
           if i%args.info_epoch == 0:
-            print('Epoch: %d Valid Perplexity: %.4f'%(i, valid_perplexity))
-            print('-'*80)
-      results = []
-      for i in range(50):
-        results.extend(run_epoch(sess, test_model, test_args))
-      results = [ ' '.join(result[:-1]) for result in results ]
-      for result in results: print(result)
+            print('Epoch: %d Train Perplexity: %.4f'%(i, train_perplexity))
+          if args.train_num < 1450:
+            valid_perplexity = run_epoch(sess, valid_model, valid_args)
+            if i%args.info_epoch == 0:
+              print('Epoch: %d Valid Perplexity: %.4f'%(i, valid_perplexity))
+              print('-'*80)
+        results = predict(sess, test_model, test_args)
+    for result in results: print(result)
   filelist = open(args.inference_list, 'r').read().splitlines()
   filenames = [ fl for fl in filelist ]
   output = [{"caption": result, "id": filename}
@@ -9,6 +9,8 @@ from tensorflow.contrib.seq2seq.python.ops.attention_decoder_fn \
 import tensorflow.contrib.seq2seq as seq2seq
 from tensorflow.contrib.seq2seq import sequence_loss as sequence_loss
 from tensorflow.contrib.layers import legacy_fully_connected as fully_connected
+import tf_input
+import feature_store
 
 class S2S(object):
 
@@ -40,16 +42,35 @@ class S2S(object):
       b_encoder_cell = tf.contrib.rnn.MultiRNNCell([rnn_cell(1) for _ in
                                                     range(para.layer_num)])
     #feed in data in batches
+    self._store = feature_store.load(self.get_filenames(para))
+    #frames of the store may be projected to fewer dimensions
+    if self._store is not None: para.video_dim = self._store.dim
     if not self.is_test():
-      video, caption, v_len, c_len = self.get_single_example(para)
-      videos, captions, v_lens, c_lens =\
-          tf.train.batch([video, caption, v_len, c_len],
-                         batch_size=para.batch_size, dynamic_pad=True)
-      #sparse tensor cannot be sliced
-      targets = tf.sparse_tensor_to_dense(captions)
+      if para.tf_data:
+        def parse(serialized_example):
+          video, caption, v_len, c_len =\
+              self.parse_example(para, serialized_example)
+          return video, tf.sparse_tensor_to_dense(caption), v_len, c_len
+        videos, targets, v_lens, c_lens =\
+            tf_input.batch(self.get_filenames(para), parse, para.batch_size,
+                           shuffle=False, cache=para.cache_data)
+      else:
+        video, caption, v_len, c_len = self.get_single_example(para)
+        videos, captions, v_lens, c_lens =\
+            tf.train.batch([video, caption, v_len, c_len],
+                           batch_size=para.batch_size, dynamic_pad=True)
+        #sparse tensor cannot be sliced
+        targets = tf.sparse_tensor_to_dense(captions)
       decoder_in = targets[:, :-1]
       decoder_out = targets[:, 1:]
       c_lens = tf.to_int32(c_lens)
+    elif para.tf_data:
+      videos, v_lens =\
+          tf_input.batch(self.get_filenames(para),
+                         lambda serialized_example:
+                         self.parse_example(para, serialized_example),
+                         para.batch_size, shuffle=False,
+                         cache=para.cache_data)
     else:
       video, v_len = self.get_single_example(para)
       videos, v_lens =\
@@ -195,35 +216,36 @@ class S2S(object):
   def is_valid(self): return self._para.mode == 1
   def is_test(self): return self._para.mode == 2
 
-  def get_single_example(self, para):
-    '''get one example from TFRecorder file using tf default queue runner'''
+  def get_filenames(self, para):
+    '''TFRecorder files of the mode'''
     if self.is_test():
       filelist = open(para.testing_id, 'r').read().splitlines()
-      filenames = [para.testing_dir+'/'+fl+'.tfr' for fl in filelist]
-      f_queue = tf.train.string_input_producer(filenames, shuffle=False)
-    else:
-      filelist = open(para.train_list, 'r').read().splitlines()
-      filenames = [fl for fl in filelist]
-      if self.is_train(): filenames = filenames[:para.train_num]
-      else: filenames = filenames[para.train_num:]
-      f_queue = tf.train.string_input_producer(filenames, shuffle=False)
+      return [para.testing_dir+'/'+fl+'.tfr' for fl in filelist]
+    filelist = open(para.train_list, 'r').read().splitlines()
+    filenames = [fl for fl in filelist]
+    if self.is_train(): return filenames[:para.train_num]
+    else: return filenames[para.train_num:]
+
+  def get_single_example(self, para):
+    '''get one example from TFRecorder file using tf default queue runner'''
+    f_queue = tf.train.string_input_producer(self.get_filenames(para),
+                                             shuffle=False)
     reader = tf.TFRecordReader()
     _, serialized_example = reader.read(f_queue)
-
+    return self.parse_example(para, serialized_example)
+
+  def parse_example(self, para, serialized_example):
+    '''video of an example and its length, with its caption as a sparse
+    tensor and the caption length unless testing'''
+    features = {} if self.is_test() else\
+        {'caption':tf.VarLenFeature(tf.int64)}
+    video, feature = feature_store.parse_video(
+        serialized_example, self._store, para.video_dim, para.video_step,
+        features=features)
     if self.is_test():
-      feature = tf.parse_single_example(serialized_example, features={
-        'video': tf.VarLenFeature(tf.float32)})
-      video = tf.sparse_tensor_to_dense(feature['video'])
-      video = tf.reshape(video, [-1, para.video_dim])[::para.video_step]
       return video, tf.shape(video)[0]
-    else:
-      feature = tf.parse_single_example(serialized_example, features={
-        'video':tf.VarLenFeature(tf.float32),
-        'caption':tf.VarLenFeature(tf.int64)})
-      video = tf.sparse_tensor_to_dense(feature['video'])
-      video = tf.reshape(video, [-1, para.video_dim])[::para.video_step]
-      caption = feature['caption']
-      return video, caption, tf.shape(video)[0], tf.shape(caption)[0]-1
+    caption = feature['caption']
+    return video, caption, tf.shape(video)[0], tf.shape(caption)[0]-1
 
   @property
   def cost(self): return self._cost
@@ -395,6 +417,12 @@ if __name__ == '__main__':
   parser.add_argument('-b', '--beam_search', type=int,
                       default=default_beam_size, nargs='?',
                       help='Size of beam search.(default:%d)'%default_beam_size)
+  parser.add_argument('-td', '--tf_data', action='store_true',
+                      help='Read TFRecorder files with the tf.data pipeline '
+                      'of tf_input.py instead of queue runners.')
+  parser.add_argument('-ca', '--cache_data', action='store_true',
+                      help='With --tf_data, keep parsed records in memory '
+                      'after the first pass.')
   parser.add_argument('-vf', '--vocab_file', type=str, nargs='?',
                       default=default_vocab_file, help='Vocab file in .json'
                       ' format with all voabularies '
@@ -0,0 +1 @@
+../hw1/tf_input.py
\ No newline at end of file
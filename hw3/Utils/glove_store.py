@@ -0,0 +1 @@
+../../hw1/glove_store.py
\ No newline at end of file
@@ -4,6 +4,7 @@ from os.path import join, isfile
 import numpy as np
 import argparse
 from Utils import skipthoughts
+from Utils import glove_store
 import h5py
 import multiprocessing
 from multiprocessing import Process, Queue
@@ -83,15 +84,11 @@ def main():
       caption_vectors[key] = new_val
 
   elif args.vector_type == 4:
-    wordvecs = open(args.glove_file, 'r').read().splitlines()
-    wordvecs = [wordvec.split() for wordvec in wordvecs]
-    wordvecs = dict([[wordvec[0], np.array([wordvec[1:]], dtype=np.float32)]
-                      for wordvec in wordvecs])
+    wordvecs = glove_store.GloveStore(args.glove_file)
     caption_vectors = {}
     for key, val in captions.items():
       new_val = [val[0], val[2]] if val[1] == 'hair' else [val[2], val[0]]
-      caption_vectors[key] =\
-        np.hstack((wordvecs[new_val[0]], wordvecs[new_val[1]]))
+      caption_vectors[key] = wordvecs.rows(new_val).reshape(1, -1)
 
   filename = join(args.data_set, args.method_dir, args.out_file)
   if os.path.isfile(filename):
@@ -4,6 +4,7 @@ from os.path import join, isfile
 import numpy as np
 import argparse
 from Utils import skipthoughts
+from Utils import glove_store
 import h5py
 import time
 import threading
@@ -122,15 +123,12 @@ def save_caption(args):
         np.array([np.hstack((one_hot_hair,one_hot_eyes))])
 
   elif args.vector_type == 4:
-    wordvecs = open(args.glove_file, 'r').read().splitlines()
-    wordvecs = [wordvec.split() for wordvec in wordvecs]
-    wordvecs = dict([[wordvec[0], np.array([wordvec[1:]], dtype=np.float32)]
-                      for wordvec in wordvecs])
+    wordvecs = glove_store.GloveStore(args.glove_file)
 
     encoded_captions = {}
     for key, val in tags.items():
       encoded_captions[key+'.jpg'] =\
-        np.hstack((wordvecs[val[0][0]], wordvecs[val[1][0]]))
+        wordvecs.rows([val[0][0], val[1][0]]).reshape(1, -1)
 
   h = h5py.File(join(args.data_set, args.method_dir, args.out_file), 'w')
   for key in encoded_captions: